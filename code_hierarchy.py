@@ -0,0 +1,86 @@
+# The ICD10 and ICPC code hierarchies (Data/icd.csv and Data/icpc.csv) as
+# integer-coded tables, shared by everything that aggregates events to a level.
+#   Every code gets a code id, and every level (CODE, SUB-CAT, MAIN-CAT and,
+# for ICPC, COLOR) a vocabulary of its own. The table holds, per code id, the
+# id of its aggregate at every level:
+#     table[code_id, hierarchy.levels.index(level)] => level id
+# so aggregating an array of code ids is a single array index.
+#   Each hierarchy is read only once per process.
+
+from support import config as CFG
+from support import my_csv as CSV
+from support import logging as LOG
+from support import vocabulary as VOC
+
+import numpy
+
+
+_FILES = {
+    'icd': ('icd.csv', ('CODE', 'SUB-CAT', 'MAIN-CAT')),
+    'icpc': ('icpc.csv', ('CODE', 'SUB-CAT', 'MAIN-CAT', 'COLOR')),
+}
+
+# Event categories whose events are codes in a hierarchy
+_CATEGORY_HIERARCHIES = {'icd': 'icd', 'ana': 'icpc', 'dia': 'icpc', 'int': 'icpc', 'rfe': 'icpc'}
+
+_hierarchies = {}  # name => CodeHierarchy
+
+
+def read(name):
+    if name not in _hierarchies:
+        _hierarchies[name] = _CodeHierarchyReader().run(name)
+    return _hierarchies[name]
+
+
+# Returns the hierarchy of an event category, or None if its events are not
+# codes in a hierarchy (and so can only be used at the CODE level).
+def of_category(tla):
+    name = _CATEGORY_HIERARCHIES.get(tla)
+    return read(name) if name else None
+
+
+class CodeHierarchy:
+
+    def __len__(self):
+        return len(self.codes)
+
+    # Converts codes to code ids. Unknown codes raise a KeyError.
+    def encode(self, codes):
+        return numpy.array([self.code_index[code] for code in codes], dtype='int32').reshape(-1)
+
+    # Aggregates code ids to level ids, which index self.names[level].
+    def level_ids(self, code_ids, level):
+        return self.table[code_ids, self.levels.index(level)]
+
+    # The name of the aggregate of every code at the given level, by code id.
+    def level_names(self, level):
+        names = self.names[level]
+        return [names[level_id] for level_id in self.table[:, self.levels.index(level)].tolist()]
+
+
+class _CodeHierarchyReader:
+
+    def run(self, name):
+        basename, levels = _FILES[name]
+        LOG.enter('Reading {} mapping'.format(name.upper()))
+        filename = CFG.DATA_DIR / basename
+        LOG.message('From {}'.format(filename))
+        vocabularies = [VOC.Vocabulary() for level in levels]
+        rows = []
+        with CSV.FileReader(filename) as source:
+            assert next(source) == list(levels)
+            for row in source:
+                ids = [vocabulary.encode(value) for vocabulary, value in zip(vocabularies, row)]
+                if ids[0] < len(rows):
+                    rows[ids[0]] = ids  # Like a dict, the last row of a code wins
+                else:
+                    rows.append(ids)
+        hierarchy = CodeHierarchy()
+        hierarchy.levels = levels
+        hierarchy.codes = vocabularies[0].words
+        hierarchy.code_index = vocabularies[0].index
+        hierarchy.names = {level: vocabulary.words for level, vocabulary in zip(levels, vocabularies)}
+        hierarchy.table = numpy.array(rows, dtype='int32').reshape(len(rows), len(levels))
+        LOG.message('{} codes'.format(len(hierarchy)))
+        LOG.leave()
+        return hierarchy
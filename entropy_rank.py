@@ -7,9 +7,12 @@ from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
 
-from collections import Counter, defaultdict
+from collections import Counter
+import keyword_table
 import math
+import multiprocessing
 import scipy.stats
+import time
 
 
 # Kullback-Leibler divergence.
@@ -29,52 +32,148 @@ def kullback_leibler(P, Q):
     return divergence
 
 
+# Row-wise kullback_leibler for two matrices: one divergence per row.
+# Rows for which kullback_leibler would fail yield nan.
+def kullback_leibler_rows(P, Q):
+    assert P.shape == Q.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = P / P.sum(axis=1, keepdims=True)
+        q = Q / Q.sum(axis=1, keepdims=True)
+        terms = np.where((P > 0.0) & (Q > 0.0), p * np.log(p / q), 0.0)
+    return terms.sum(axis=1)
+
+
 def model_curve(x, a, b, c):
     return a * np.exp(-b * x) + c
 
 
-# Represents one occurrence of a keyword in the corpus.
-class KeywordEvent:
-
-    def __init__(self, praktijk_id, patient_id, days_to_live, keyword, postag):
-        self.ident = '{}_{}'.format(praktijk_id, patient_id)
-        self.period = int(days_to_live) // PAR.PERIOD_LENGTH
-        self.keyword = keyword
-        self.postag = postag
+# Batched fits whose normal matrix (JᵀJ) is worse conditioned than this are
+# left to curve_fit (see fit_model_curves).
+MAX_CONDITION = 1e8
+
+
+# Fits model_curve to every row of Y at once, within the bounds used by
+# Keyword.calculate_relative_entropy, by Levenberg-Marquardt iterations that
+# are vectorised over the rows. Steps leaving the bounds are clipped back.
+# Returns the (a, b, c) parameters per row, and which rows converged. Rows
+# that did not improve on the starting point, that stalled (no step improves
+# them, however small), that ended on a bound, where clipping makes the
+# iterations unreliable, or that ended where the parameters are nearly
+# interchangeable (JᵀJ conditioned worse than MAX_CONDITION, as when b near 0
+# makes a and c collinear), so that the minimum found depends on the path
+# taken, do not count as converged: leave those to curve_fit.
+def fit_model_curves(x, Y, max_iterations=200, ftol=1e-10):
+    num_rows = len(Y)
+    max_counts = Y.max(axis=1)
+    lower = np.stack([-2 * max_counts, np.full(num_rows, -2.0), np.zeros(num_rows)], axis=1)
+    upper = np.stack([2 * max_counts, np.full(num_rows, 2.0), np.full(num_rows, np.inf)], axis=1)
+    # Start where curve_fit starts within these bounds (the middle of finite
+    # bounds, lower bound + 1 for c), so that both usually find the same minimum
+    theta = np.stack([np.zeros(num_rows), np.zeros(num_rows), np.ones(num_rows)], axis=1)
+
+    def residuals(theta, rows):
+        return model_curve(x, theta[:, 0:1], theta[:, 1:2], theta[:, 2:3]) - Y[rows]
+
+    cost = 0.5 * (residuals(theta, slice(None)) ** 2).sum(axis=1)
+    start_cost = cost.copy()
+    damping = np.full(num_rows, 1e-3)
+    converged = np.zeros(num_rows, dtype=bool)
+    stalled = np.zeros(num_rows, dtype=bool)
+    for iteration in range(max_iterations):
+        rows = np.flatnonzero(~converged & ~stalled & np.isfinite(cost))
+        if len(rows) == 0: break
+        a, b = theta[rows, 0:1], theta[rows, 1:2]
+        exp = np.exp(-b * x)
+        jacobian = np.stack([exp, -a * x * exp, np.ones_like(exp)], axis=2)  # rows × periods × (a, b, c)
+        r = residuals(theta[rows], rows)
+        jtj = np.einsum('nhi,nhj->nij', jacobian, jacobian)
+        gradient = np.einsum('nhi,nh->ni', jacobian, r)
+        diagonal = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+        system = jtj + damping[rows, None, None] * (diagonal[:, :, None] * np.eye(3))
+        step = np.linalg.solve(system, -gradient[:, :, None])[:, :, 0]
+        proposal = np.clip(theta[rows] + step, lower[rows], upper[rows])
+        new_cost = 0.5 * (residuals(proposal, rows) ** 2).sum(axis=1)
+        better = new_cost < cost[rows]
+        improvement = cost[rows] - new_cost
+        # Accept improving steps and trust the linearisation more; otherwise trust it less
+        theta[rows[better]] = proposal[better]
+        damping[rows[better]] = np.maximum(damping[rows[better]] / 10.0, 1e-9)  # Keeps the system solvable when a and c are collinear (b = 0)
+        damping[rows[~better]] *= 10.0
+        # Converged when an accepted step hardly improves the fit
+        done = better & (improvement <= ftol * np.maximum(cost[rows], 1e-300))
+        cost[rows[better]] = new_cost[better]
+        converged[rows[done]] = True
+        stalled[rows[damping[rows] > 1e10]] = True
+    on_bound = ((theta <= lower) | (theta >= upper)).any(axis=1)
+    a, b = theta[:, 0:1], theta[:, 1:2]
+    exp = np.exp(-b * x)
+    jacobian = np.stack([exp, -a * x * exp, np.ones_like(exp)], axis=2)
+    with np.errstate(all='ignore'):
+        condition = np.linalg.cond(np.einsum('nhi,nhj->nij', jacobian, jacobian))
+    well_conditioned = np.isfinite(condition) & (condition < MAX_CONDITION)
+    # Like curve_fit, give up on rows without any counts: their bounds are empty
+    return theta, converged & ~on_bound & well_conditioned & (cost < start_cost) & np.isfinite(cost) & (max_counts > 0)
 
 
 # Represents a unique keyword.
 class Keyword:
 
-    def __init__(self, keyword, postag):
+    # The counts are rows of EntropyRanker's keywords × periods count matrices.
+    def __init__(self, keyword, postag, absolute_counts, patients):
         self.keyword = keyword
         self.postag = postag
-        self.absolute_counts = PAR.HISTORY_LENGTH * [0]
-        self.relative_counts = PAR.HISTORY_LENGTH * [0.0]
+        self.absolute_counts = absolute_counts
+        self.relative_counts = np.zeros(len(absolute_counts))
+        self.patients = patients
 
     def total_absolute_count(self):
-        return sum(self.absolute_counts)
+        return int(self.absolute_counts.sum())
 
     def total_relative_count(self):
-        return sum(self.relative_counts)
+        return float(self.relative_counts.sum())
 
     def calculate_relative_entropy(self):
-        try:
-            max_count = max(self.relative_counts)
-            counts = np.array(self.relative_counts, np.double)
-            bounds = (-2 * max_count, -2, 0), (2 * max_count, 2, np.inf)
-            (a, b, c), pcov = curve_fit(f=model_curve, xdata=self.periods, ydata=counts, bounds=bounds)
-            # FIX: Kullback-Leibler will fail if a+c<=0, which happens often enough
-            # (500 out of 12000 keywords) to be a problem. Since -a/c is almost always
-            # just above 1 in those cases, we salvage the situation by setting a=-c.
-            if (a + c < 0.0): a = -c
-            fit = model_curve(self.periods, a, b, c)
-            # self.entropy = scipy.stats.entropy(counts, fit)
-            self.relative_abc = a, b, c
-            self.relative_entropy = kullback_leibler(counts, fit)
-        except:
-            self.relative_abc = None, None, None
-            self.relative_entropy = None
+        counts = np.array(self.relative_counts, np.double)
+        self.relative_abc, self.relative_entropy, self.failure = fit_relative_count(self.periods, counts)
+
+
+# Fits model_curve to the relative counts of one keyword with curve_fit, and
+# returns ((a, b, c), entropy, None), or ((None, None, None), None, cause) if
+# the fit or the entropy calculation fails. The cause is the exception name.
+def fit_relative_count(periods, counts):
+    try:
+        max_count = max(counts)
+        bounds = (-2 * max_count, -2, 0), (2 * max_count, 2, np.inf)
+        (a, b, c), pcov = curve_fit(f=model_curve, xdata=periods, ydata=counts, bounds=bounds)
+        # FIX: Kullback-Leibler will fail if a+c<=0, which happens often enough
+        # (500 out of 12000 keywords) to be a problem. Since -a/c is almost always
+        # just above 1 in those cases, we salvage the situation by setting a=-c.
+        if (a + c < 0.0): a = -c
+        fit = model_curve(periods, a, b, c)
+        # self.entropy = scipy.stats.entropy(counts, fit)
+        return (a, b, c), kullback_leibler(counts, fit), None
+    except Exception as error:
+        return (None, None, None), None, type(error).__name__
+
+
+# Fits a chunk of keywords (rows of relative counts) in batch, falling back to
+# fit_relative_count for rows where the batched fit fails. Returns a list of
+# ((a, b, c), entropy, failure cause, fitted in batch) per row. Runs in the
+# worker processes of EntropyRanker.calculate_entropies.
+def fit_relative_counts(task):
+    periods, counts = task
+    abc, converged = fit_model_curves(periods, counts)
+    a, b, c = abc[:, 0], abc[:, 1], abc[:, 2]
+    a = np.where(a + c < 0.0, -c, a)  # See fit_relative_count
+    fits = model_curve(periods, a[:, None], b[:, None], c[:, None])
+    entropies = kullback_leibler_rows(counts, fits)
+    results = []
+    for index in range(len(counts)):
+        if converged[index] and np.isfinite(entropies[index]):
+            results.append(((float(a[index]), float(b[index]), float(c[index])), float(entropies[index]), None, True))
+        else:
+            results.append(fit_relative_count(periods, counts[index]) + (False,))
+    return results
 
 
 class EntropyRanker:
@@ -95,23 +194,26 @@ class EntropyRanker:
         self.write_arff_file()            # Write ARFF file
         LOG.leave()
 
+    # The keyword events are held as parallel arrays: keyword (a pair id, see
+    # keyword_table.KeywordTable.pair_ids), period and patient.
     def read_events(self):
         LOG.enter('Reading keyword events')
-        filename = CFG.PHASE1_DIR / 'Keywords' / 'dev_kwd.csv'
-        LOG.message('From {}'.format(filename))
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG']
-            self.events = [KeywordEvent(*row) for row in source]
-        LOG.message('{} keyword events'.format(len(self.events)))
+        self.table = keyword_table.read('dev')
+        self.event_keywords = self.table.pair_ids()
+        self.event_periods = self.table.periods(PAR.PERIOD_LENGTH)
+        self.event_patients = self.table.patient_ids
+        LOG.message('{} keyword events'.format(len(self.event_keywords)))
         LOG.leave()
 
     def filter_by_period(self):
         LOG.enter('Filtering keyword events by period number')
-        filtered_events = [event for event in self.events if 0 <= event.period < PAR.HISTORY_LENGTH]
-        remove_count = len(self.events) - len(filtered_events)
-        self.events = filtered_events
+        inside = (0 <= self.event_periods) & (self.event_periods < PAR.HISTORY_LENGTH)
+        remove_count = len(inside) - int(inside.sum())
+        self.event_keywords = self.event_keywords[inside]
+        self.event_periods = self.event_periods[inside]
+        self.event_patients = self.event_patients[inside]
         LOG.message('Removed {} keyword events with a negative period number'.format(remove_count))
-        LOG.message('{} keyword events remaining'.format(len(self.events)))
+        LOG.message('{} keyword events remaining'.format(len(self.event_keywords)))
         LOG.leave()
 
     # For every keyword and period, count how often that keyword appears in
@@ -121,51 +223,57 @@ class EntropyRanker:
     # of a keyword in a period by the total number of keyword events in that
     # period. This compensates for the fact that keyword events are not evenly
     # distributed over all periods.
+    #   The counts are kept in keywords × periods matrices, with the keywords
+    # in order of first appearance. Row i belongs to self.keywords[i].
     def count_keywords(self):
         LOG.enter('Counting keyword events per period')
-        self.keywords = dict()  # (keyword, postag) => Keyword
+        pairs, first_index, inverse = np.unique(self.event_keywords, return_index=True, return_inverse=True)
+        order = np.argsort(first_index, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.event_keywords = rank[inverse.ravel()]  # Pair id => keyword number
+        self.keyword_pairs = pairs[order]
         # Absolute frequencies
-        for event in self.events:
-            keyword = self.keywords.get((event.keyword, event.postag))
-            if keyword is None:
-                keyword = Keyword(event.keyword, event.postag)
-                self.keywords[(event.keyword, event.postag)] = keyword
-            keyword.absolute_counts[event.period] += 1
-        LOG.message('{} unique keywords'.format(len(self.keywords)))
+        num_keywords = len(self.keyword_pairs)
+        cells = self.event_keywords * PAR.HISTORY_LENGTH + self.event_periods
+        self.absolute_counts = np.bincount(cells, minlength=num_keywords * PAR.HISTORY_LENGTH).reshape(num_keywords, PAR.HISTORY_LENGTH)
+        LOG.message('{} unique keywords'.format(num_keywords))
         LOG.leave()
 
-    def calculate_relative_counts(self):
-        LOG.message('Calculating relative event counts')
-        # Get the total number of keyword events in every period (vertical totals).
-        total_counts = PAR.HISTORY_LENGTH * [0]
-        for keyword in self.keywords:
-            for period in range(PAR.HISTORY_LENGTH):
-                total_counts[period] += keyword.absolute_counts[period]
-        # Divide absolute counts by totals to get relative counts.
-        for keyword in self.keywords:
-            for period in range(PAR.HISTORY_LENGTH):
-                if total_counts[period]:  # Avoid division by zero
-                    keyword.relative_counts[period] = keyword.absolute_counts[period] / total_counts[period]
-
+    # Count the distinct (keyword, patient) pairs of every keyword.
     def count_patients(self):
         LOG.message('Counting patients per keyword')
-        patients = defaultdict(set)
-        for event in self.events:
-            patients[(event.keyword, event.postag)].add(event.ident)
-        for (keyword, postag), idents in patients.items():
-            self.keywords[(keyword, postag)].patients = len(idents)
+        num_patients = len(self.table.patients)
+        keyword_patients = np.unique(self.event_keywords * num_patients + self.event_patients)
+        patients = np.bincount(keyword_patients // num_patients, minlength=len(self.keyword_pairs))
+        self.keywords = []
+        for pair, absolute_counts, count in zip(self.keyword_pairs, self.absolute_counts, patients):
+            keyword = Keyword(*self.table.pair(pair), absolute_counts, int(count))
+            keyword.pair = pair  # See keyword_table.KeywordTable.pair_ids
+            self.keywords.append(keyword)
 
     # Filter keywords based on total number of events.
     def filter_by_frequency(self):
         MIN_EVENTS = 10  # TODO: move to param.txt?
         LOG.enter('Filtering keywords by event count')
-        filtered_keywords = [keyword for keyword in self.keywords.values() if keyword.total_absolute_count() >= MIN_EVENTS]
-        removed = len(self.keywords) - len(filtered_keywords)
-        self.keywords = filtered_keywords
+        keep = self.absolute_counts.sum(axis=1) >= MIN_EVENTS
+        removed = len(self.keywords) - int(keep.sum())
+        self.keywords = [keyword for keyword, kept in zip(self.keywords, keep) if kept]
+        self.absolute_counts = self.absolute_counts[keep]
         LOG.message('Removed {} keywords appearing fewer than {} times'.format(removed, MIN_EVENTS))
         LOG.message('{} unique keywords remaining'.format(len(self.keywords)))
         LOG.leave()
 
+    def calculate_relative_counts(self):
+        LOG.message('Calculating relative event counts')
+        # Get the total number of keyword events in every period (vertical totals).
+        total_counts = self.absolute_counts.sum(axis=0)
+        # Divide absolute counts by totals to get relative counts.
+        self.relative_counts = np.zeros(self.absolute_counts.shape)
+        np.divide(self.absolute_counts, total_counts, out=self.relative_counts, where=total_counts > 0)  # Avoid division by zero
+        for keyword, relative_counts in zip(self.keywords, self.relative_counts):
+            keyword.relative_counts = relative_counts
+
     # def curve_plot(self):
     #     periods = np.linspace(0, 60, 61)
     #     for keyword in self.keywords:
@@ -182,16 +290,43 @@ class EntropyRanker:
     #         except:
     #             pass
 
-    def calculate_entropies(self, ):
+    # Fit the keywords in chunks, in PAR.PROCESSES worker processes. Within a
+    # chunk the keywords are fitted in batch; keywords for which the batched
+    # fit fails are fitted one at a time. Failures are counted by cause.
+    def calculate_entropies(self):
+        CHUNK_SIZE = 500  # Keywords per task
         LOG.enter('Calculating keyword entropies')
-        progress = len(self.keywords)
-        for keyword in self.keywords:
-            if progress % 100 == 0:
-                print('  Progress: {} '.format(progress), end='\r')
-            progress -= 1
-            keyword.calculate_relative_entropy()
+        counts = self.relative_counts
+        tasks = [(Keyword.periods, counts[begin:begin + CHUNK_SIZE]) for begin in range(0, len(counts), CHUNK_SIZE)]
+        time_begin = time.time()
+        if PAR.PROCESSES > 1:
+            with multiprocessing.Pool(PAR.PROCESSES) as pool:
+                batched, failures = self.store_fits(pool.imap(fit_relative_counts, tasks))
+        else:
+            batched, failures = self.store_fits(map(fit_relative_counts, tasks))
+        seconds = time.time() - time_begin
+        LOG.message('{} keywords fitted in {:.3f} sec ({:.0f} fits/sec)'.format(len(self.keywords), seconds, len(self.keywords) / seconds if seconds else 0))
+        LOG.message('{} fitted in batch, {} one at a time'.format(batched, len(self.keywords) - batched))
+        LOG.message('{} failures'.format(sum(failures.values())))
+        for cause, count in failures.most_common():
+            LOG.message('{}: {}'.format(cause, count))
         LOG.leave()
 
+    # Stores the fits of the chunks in self.keywords. Returns the number of
+    # keywords fitted in batch and the failures by cause.
+    def store_fits(self, results):
+        keywords = iter(self.keywords)
+        batched, failures, progress = 0, Counter(), 0
+        for chunk in results:
+            for abc, entropy, failure, in_batch in chunk:
+                keyword = next(keywords)
+                keyword.relative_abc, keyword.relative_entropy, keyword.failure = abc, entropy, failure
+                batched += in_batch
+                if failure: failures[failure] += 1
+            progress += len(chunk)
+            print('  Progress: {} of {} '.format(progress, len(self.keywords)), end='\r')
+        return batched, failures
+
     def write_keywords(self):
         LOG.enter('Writing keyword entropies')
         filename = CFG.PHASE2_DIR / 'Temp' / 'entropies.csv'
@@ -225,6 +360,9 @@ class EntropyRanker:
             for keyword in self.keywords:
                 target.write("@attribute '{}:{}' numeric\n".format(keyword.keyword, keyword.postag))
             target.write("@attribute 'DaysToLive' numeric\n")
+            # Data
+            count = self.table.write_arff_data(target, [keyword.pair for keyword in self.keywords])
+        LOG.message('{} instances'.format(count))
         LOG.leave()
 
 
@@ -16,6 +16,25 @@ def read(data_set):
     return corpus
 
 
+# Reads the part of a single praktijk that belongs to the data set.
+# Praktijken are independent, so they can be read in separate processes.
+def read_praktijk(ident, data_set):
+    praktijk = _PraktijkReader().run(ident)
+    _split(praktijk, data_set)
+    return praktijk
+
+
+# The oldest 90% of the deceased patients of every praktijk form the
+# development set, the rest the validation set.
+def _split(praktijk, data_set):
+    praktijk.patienten.sort(key=lambda patient: patient.overlijdensdatum)
+    split = len(praktijk.patienten) * 9 // 10
+    if data_set == DataSet.DEVELOPMENT:
+        del praktijk.patienten[split:]
+    else:
+        del praktijk.patienten[:split]
+
+
 # These domain classes are all data-only.
 # Refer to Corpus (design).graphml for documentation.
 class Corpus: pass
@@ -43,12 +62,7 @@ class _CorpusReader:
             corpus.praktijken.append(praktijk)
         # Filter the data
         for praktijk in corpus.praktijken:
-            praktijk.patienten.sort(key=lambda patient: patient.overlijdensdatum)
-            split = len(praktijk.patienten) * 9 // 10
-            if data_set == DataSet.DEVELOPMENT:
-                del praktijk.patienten[split:]
-            else:
-                del praktijk.patienten[:split]
+            _split(praktijk, data_set)
         #
         LOG.leave()
         return corpus
@@ -3,7 +3,8 @@ from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
 
-from collections import Counter, defaultdict
+import keyword_table
+import numpy
 
 
 class FrequencyRanker:
@@ -18,26 +19,25 @@ class FrequencyRanker:
 
     def read_keywords(self):
         LOG.enter('reading keywords')
-        filename = CFG.PHASE1_DIR / 'Keywords' / 'dev_kwd.csv'
-        LOG.message('from {}'.format(filename))
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG']
-            self.keywords = []
-            for praktijk_id, patient_id, days_to_live, keyword, postag in source:
-                self.keywords.append((keyword, postag))
-        LOG.message('{} keywords read'.format(len(self.keywords)))
+        self.table = keyword_table.read('dev')
+        LOG.message('{} keywords read'.format(len(self.table)))
         LOG.leave()
 
+    # Counts every (keyword, postag) pair. Pairs with equal counts stay in
+    # order of first appearance.
     def get_frequencies(self):
         LOG.message('calculating frequencies')
-        counts = Counter(self.keywords)
-        total_count = sum(counts.values())
-        counts = sorted(counts.items(), key=lambda x: x[1], reverse=True)  # Sort by descending count
+        table = self.table
+        pairs, first_index, counts = numpy.unique(table.pair_ids(), return_index=True, return_counts=True)
+        order = numpy.lexsort((first_index, -counts))  # Sort by descending count
+        total_count = len(table)
         self.frequencies = []
+        self.frequency_pairs = pairs[order]
         rel_cum_freq = 0.0
-        for keyword, count in counts:
-            abs_freq = count
-            rel_freq = count / total_count
+        for pair, count in zip(pairs[order], counts[order]):
+            keyword = table.pair(pair)
+            abs_freq = int(count)
+            rel_freq = abs_freq / total_count
             rel_cum_freq += rel_freq
             self.frequencies.append((keyword, abs_freq, rel_freq, rel_cum_freq))
 
@@ -63,6 +63,9 @@ class FrequencyRanker:
             for (keyword, postag), abs_freq, rel_freq, rel_cum_freq in self.frequencies:
                 target.write("@attribute '{}:{}' numeric\n".format(keyword, postag))
             target.write("@attribute 'DaysToLive' numeric\n")
+            # Data
+            count = self.table.write_arff_data(target, self.frequency_pairs)
+        LOG.message('{} instances'.format(count))
         LOG.leave()
 
 # Main program
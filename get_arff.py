@@ -2,24 +2,26 @@ from support import config as CFG
 from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
+from support import vocabulary as VOC
+from support import arff as ARFF
 
-from collections import Counter, defaultdict
+from array import array
+import code_hierarchy
+import numpy
 
 
 class ArffGenerator:
 
     def run(self):
         LOG.enter(self.__class__.__name__ + '.run()')
-        self.get_icd_mapping()
-        self.get_icpc_mapping()
         for event_category in CFG.EVENT_CATEGORIES:
             LOG.enter(event_category.full_name)
+            self.read_events(event_category)
             level_param = event_category.tla.upper() + '_LEVELS'
             levels = getattr(PAR, level_param)
             for level in levels:
                 LOG.enter('Aggregation level {}'.format(level))
-                self.read_events(event_category, level)
-                self.get_frequencies()
+                self.get_frequencies(event_category, level)
                 for selector in PAR.EVENT_SELECTORS:
                     LOG.enter('Selector {}'.format(selector))
                     self.select_attributes(selector)
@@ -29,66 +31,66 @@ class ArffGenerator:
             LOG.leave()
         LOG.leave()
 
-    def get_icd_mapping(self):
-        LOG.enter('Reading ICD mapping')
-        filename = CFG.DATA_DIR / 'icd.csv'
-        LOG.message('from {}'.format(filename))
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['CODE', 'SUB-CAT', 'MAIN-CAT']
-            self.icd_mapping = {}
-            for code, subcat, maincat in source:
-                self.icd_mapping[code] = {'CODE': code, 'SUB-CAT': subcat, 'MAIN-CAT': maincat}
-        LOG.leave()
-
-    def get_icpc_mapping(self):
-        LOG.enter('Reading ICPC mapping')
-        filename = CFG.DATA_DIR / 'icpc.csv'
-        LOG.message('from {}'.format(filename))
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['CODE', 'SUB-CAT', 'MAIN-CAT', 'COLOR']
-            self.icpc_mapping = {}
-            for code, subcat, maincat, color in source:
-                self.icpc_mapping[code] = {'CODE': code, 'SUB-CAT': subcat, 'MAIN-CAT': maincat, 'COLOR': color}
-        LOG.leave()
-
-    def read_events(self, event_category, level):
+    # Reads the events of a category once, for all aggregation levels. Events
+    # are stored as integer columns: code id (into self.codes), patient id
+    # (into self.patients) and days to live.
+    def read_events(self, event_category):
         filename = CFG.PHASE1_DIR / 'Events' / 'dev_{}.csv'.format(event_category.tla)
         LOG.message('Reading {}'.format(filename))
+        codes, patients = VOC.Vocabulary(), VOC.Vocabulary()
+        code_ids, patient_ids, days = array('i'), array('i'), array('i')
         with CSV.FileReader(filename) as source:
             assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'EVENT']
-            self.events = []
             for praktijk_id, patient_id, days_to_live, event in source:
-                days_to_live = int(days_to_live)
-                if event_category.tla == 'icd':
-                    event = self.icd_mapping[event][level]
-                elif event_category.tla in {'ana', 'dia', 'int', 'rfe'}:
-                    event = self.icpc_mapping[event][level]
-                self.events.append((praktijk_id, patient_id, days_to_live, event))
-        LOG.message('{} events'.format(len(self.events)))
+                code_ids.append(codes.encode(event))
+                patient_ids.append(patients.encode((praktijk_id, patient_id)))
+                days.append(int(days_to_live))
+        self.codes = codes.words
+        self.patients = patients.words
+        self.event_codes = numpy.array(code_ids, dtype='int32')
+        self.event_patients = numpy.array(patient_ids, dtype='int32')
+        self.event_days = numpy.array(days, dtype='int32')
+        # Per code: number of events and index of its first event
+        self.code_counts = numpy.bincount(self.event_codes, minlength=len(self.codes))
+        self.code_first = numpy.full(len(self.codes), len(self.event_codes))
+        numpy.minimum.at(self.code_first, self.event_codes, numpy.arange(len(self.event_codes)))
+        LOG.message('{} events'.format(len(self.event_codes)))
+
+    # Maps every code to its aggregate at the given level, as an array of ids
+    # into self.level_names.
+    def get_level_mapping(self, event_category, level):
+        hierarchy = code_hierarchy.of_category(event_category.tla)
+        if hierarchy:
+            self.level_names = hierarchy.names[level]
+            return hierarchy.level_ids(hierarchy.encode(self.codes), level).astype('int64')
+        assert level == 'CODE'
+        self.level_names = self.codes
+        return numpy.arange(len(self.codes))
 
-    def get_frequencies(self):
+    # Counts the events per aggregate from the counts per code, and sorts the
+    # aggregates by descending count (ties in order of first appearance).
+    def get_frequencies(self, event_category, level):
         LOG.message('calculating frequencies')
-        counts = Counter()
-        for praktijk_id, patient_id, days_to_live, event in self.events:
-            counts[event] += 1
-        total_count = sum(counts.values())
-        counts = sorted(counts.items(), key=lambda x: x[1], reverse=True)  # Sort by descending count
-        self.frequencies = []
-        rel_cum_freq = 0.0
-        for event, count in counts:
-            abs_freq = count
-            rel_freq = 100.0 * count / total_count  # percent
-            rel_cum_freq += rel_freq
-            self.frequencies.append((event, abs_freq, rel_freq, rel_cum_freq))
+        level_of_code = self.get_level_mapping(event_category, level)
+        self.event_levels = level_of_code[self.event_codes]
+        counts = numpy.bincount(level_of_code, weights=self.code_counts, minlength=len(self.level_names)).astype('int64')
+        first = numpy.full(len(self.level_names), len(self.event_codes))
+        numpy.minimum.at(first, level_of_code, self.code_first)
+        order = numpy.lexsort((first, -counts))  # Sort by descending count
+        order = order[counts[order] > 0]  # Only aggregates that occur
+        self.frequency_events = [self.level_names[index] for index in order]
+        self.abs_freqs = counts[order]
+        self.rel_freqs = 100.0 * self.abs_freqs / max(len(self.event_codes), 1)  # percent
+        self.rel_cum_freqs = numpy.cumsum(self.rel_freqs)
 
     def select_attributes(self, selector):
-        for event, abs_freq, rel_freq, rel_cum_freq in self.frequencies:
-            if selector == 'ABS_FREQ':
-                self.attributes = [event for event, abs_freq, _, _ in self.frequencies if abs_freq >= PAR.ABS_FREQ_CUTOFF]
-            elif selector == 'REL_FREQ':
-                self.attributes = [event for event, _, rel_freq, _ in self.frequencies if rel_freq >= PAR.REL_FREQ_CUTOFF]
-            elif selector == 'REL_CUM_FREQ':
-                self.attributes = [event for event, _, _, rel_cum_freq in self.frequencies if rel_cum_freq <= PAR.REL_CUM_FREQ_CUTOFF]
+        if selector == 'ABS_FREQ':
+            selected = self.abs_freqs >= PAR.ABS_FREQ_CUTOFF
+        elif selector == 'REL_FREQ':
+            selected = self.rel_freqs >= PAR.REL_FREQ_CUTOFF
+        elif selector == 'REL_CUM_FREQ':
+            selected = self.rel_cum_freqs <= PAR.REL_CUM_FREQ_CUTOFF
+        self.attributes = [event for event, keep in zip(self.frequency_events, selected) if keep]
         LOG.message('{} unique events (attributes)'.format(len(self.attributes)))
 
     def write_arff(self, selector, level, event_category):
@@ -98,9 +100,7 @@ class ArffGenerator:
         self.target = open(str(filename), 'w')
         self.write_relation(event_category)
         self.write_attributes()
-        if level == 'CODE':
-            self.get_patients()  # Events per patient (ARFF rows)
-            self.get_index()     # Column number per attribute (ARFF columns)
+        self.write_data()
         self.target.close()
         LOG.leave()
 
@@ -112,14 +112,16 @@ class ArffGenerator:
             self.target.write("@attribute '{}' numeric  % {}\n".format(attribute, index))
         self.target.write("@attribute 'DaysToLive' numeric  % {}\n".format(len(self.attributes)))
 
-    def get_patients(self):
-        self.patients = defaultdict(list)
-        for praktijk_id, patient_id, days_to_live, event in self.events:
-            self.patients[(praktijk_id, patient_id)].append((days_to_live, event))
-        LOG.message('{} patients'.format(len(self.patients)))
-
-    def get_index(self):
-        self.index = {attribute: index for index, attribute in enumerate(self.attributes)}
+    # One sparse instance per patient and days to live, with the number of
+    # events per attribute. Attribute columns follow write_attributes.
+    def write_data(self):
+        column_of_level = numpy.full(len(self.level_names), -1)
+        level_index = {name: level_id for level_id, name in enumerate(self.level_names)}
+        for index, attribute in enumerate(sorted(self.attributes)):
+            column_of_level[level_index[attribute]] = index
+        columns = column_of_level[self.event_levels]
+        count = ARFF.write_sparse_data(self.target, self.event_patients, self.event_days, columns, len(self.attributes))
+        LOG.message('{} instances of {} patients'.format(count, len(self.patients)))
 
 # Main program
 if __name__ == '__main__':
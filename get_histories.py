@@ -2,33 +2,82 @@ from support import config as CFG
 from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
+from support import embedding as EMB
+from support import vocabulary as VOC
+from support import history_file as HF
 
 from math import sqrt
 from pathlib import Path
-from collections import Counter, defaultdict
 from datetime import date
+from array import array
+import code_hierarchy
+import contextlib
+import csv
+import hashlib
+import multiprocessing
 import numpy
+import os
+import scipy.sparse
 
 
 class HistoryGenerator:
 
     def run(self, output_dir):
         LOG.enter(self.__class__.__name__ + '.run()')
+        # Param.txt files of older experiments lack STREAM_HISTORIES
+        run_subcorpus = self.stream_subcorpus if getattr(PAR, 'STREAM_HISTORIES', False) else self.run_subcorpus
         # Development data
-        self.run_patients(subcorpus='dev')
-        if PAR.INCLUDE_KEYWORDS:
-            self.run_keywords(output_dir, subcorpus='dev')
-        self.run_events(output_dir, subcorpus='dev')
-        self.write_histories(output_dir, filename='train.csv' if PAR.WORKFLOW == 'VALIDATION' else 'modeldata.csv')
+        run_subcorpus(output_dir, subcorpus='dev', filename='train.csv' if PAR.WORKFLOW == 'VALIDATION' else 'modeldata.csv')
         # Validation data
         if PAR.WORKFLOW == 'VALIDATION':
-            self.run_patients(subcorpus='val')
+            run_subcorpus(output_dir, subcorpus='val', filename='test.csv')
+        LOG.leave()
+
+    def run_subcorpus(self, output_dir, subcorpus, filename):
+        self.run_patients(subcorpus)
+        if PAR.INCLUDE_KEYWORDS:
+            self.run_keywords(output_dir, subcorpus)
+        self.run_events(output_dir, subcorpus)
+        self.write_histories(output_dir, filename)
+
+    # Builds and writes the histories one patient at a time, so that memory use
+    # does not grow with the number of patients. The keyword and event files are
+    # indexed by patient (see PatientFile), so their rows can be read one
+    # patient at a time, whatever their order.
+    def stream_subcorpus(self, output_dir, subcorpus, filename):
+        LOG.enter('Streaming histories')
+        self.read_pat_data(subcorpus)
+        pat_data, patients = self.pat_data, self.patients
+        if PAR.INCLUDE_KEYWORDS:
+            self.read_kwd_features(output_dir)
+        tlas = [event_category.tla for event_category in CFG.EVENT_CATEGORIES if event_category.tla in PAR.EVENT_FILTER]
+        self.evt_features = dict()  # tla => Vocabulary of features
+        for tla in tlas:
+            self.read_evt_features(tla, output_dir)
+        filename = output_dir / filename
+        LOG.message('To {}'.format(filename))
+        with contextlib.ExitStack() as stack:
             if PAR.INCLUDE_KEYWORDS:
-                self.run_keywords(output_dir, subcorpus='val')
-            self.run_events(output_dir, subcorpus='val')
-            self.write_histories(output_dir, filename='test.csv')
+                kwd_file = stack.enter_context(PatientFile(CFG.PHASE1_DIR / 'Keywords' / '{}_kwd.csv'.format(subcorpus), KWD_HEADERS, patients))
+            evt_files = dict()  # tla => PatientFile
+            for tla in tlas:
+                evt_files[tla] = stack.enter_context(PatientFile(CFG.PHASE1_DIR / 'Events' / '{}_{}.csv'.format(subcorpus, tla), EVT_HEADERS, patients))
+            # The CSV file is closed first, so the binary file is never older than it
+            binary = stack.enter_context(HF.Writer(filename.with_suffix('.npz')))
+            target = stack.enter_context(CSV.FileWriter(filename))
+            self.write_headers(target)
+            for patient, data in pat_data.items():
+                self.pat_data = {patient: data}
+                self.patients = VOC.Vocabulary([patient])
+                self.build_pat_histories()
+                if PAR.INCLUDE_KEYWORDS:
+                    self.kwd_histories = self.build_kwd_histories(self.event_table(kwd_file.rows(patient), kwd_value))
+                self.evt_histories = {tla: self.build_evt_histories(tla, self.event_table(evt_files[tla].rows(patient), evt_value)) for tla in tlas}
+                self.write_rows(target, binary)
+        LOG.message('{} periods of {} days each'.format(PAR.HISTORY_LENGTH, PAR.PERIOD_LENGTH))
+        LOG.message('{} histories'.format(len(pat_data)))
         LOG.leave()
-        
+
     def run_patients(self, subcorpus):
         LOG.enter('Patients')
         self.read_pat_data(subcorpus)
@@ -44,13 +93,16 @@ class HistoryGenerator:
         
     def run_events(self, output_dir, subcorpus):
         LOG.enter('Events')
-        self.read_icd_mapping()
-        self.read_icpc_mapping()        
-        self.evt_features = dict()  # tla => set of features
-        self.evt_data = dict()  # tla => (praktijk, patient) => (days_to_live, event)
-        self.evt_histories = dict()  # tla => histories
-        for event_category in CFG.EVENT_CATEGORIES:
-            if event_category.tla in PAR.EVENT_FILTER:
+        self.evt_features = dict()  # tla => Vocabulary of features
+        self.evt_data = dict()  # tla => EventTable
+        self.evt_histories = dict()  # tla => History
+        event_categories = [event_category for event_category in CFG.EVENT_CATEGORIES if event_category.tla in PAR.EVENT_FILTER]
+        # Param.txt files of experiments lack PROCESSES
+        processes = getattr(PAR, 'PROCESSES', 1)
+        if processes > 1 and len(event_categories) > 1:
+            self.run_events_parallel(output_dir, subcorpus, event_categories, processes)
+        else:
+            for event_category in event_categories:
                 LOG.enter(event_category.full_name)
                 tla = event_category.tla
                 self.read_evt_features(tla, output_dir)
@@ -58,37 +110,68 @@ class HistoryGenerator:
                 self.create_evt_histories(tla)
                 LOG.leave()
         LOG.leave()
+
+    # Parallel version of the loop in run_events: the event categories are
+    # independent until write_histories merges them, so every worker process
+    # reads and builds one category at a time (see build_category_histories).
+    # The histories come back as plain arrays, in the order of EVENT_CATEGORIES.
+    def run_events_parallel(self, output_dir, subcorpus, event_categories, processes):
+        LOG.message('Building {} categories in {} processes'.format(len(event_categories), processes))
+        tasks = [(event_category.tla, output_dir, subcorpus) for event_category in event_categories]
+        processes = min(processes, len(tasks))
+        # Worker processes that are not forked do not inherit the parameters, so pass them along
+        parameters = {key: getattr(PAR, key) for key in PAR.keys if hasattr(PAR, key)}
+        with multiprocessing.Pool(processes, initializer=init_category_worker, initargs=(parameters, self.patients, self.pat_filename)) as pool:
+            for event_category, (num_events, arrays) in zip(event_categories, pool.imap(build_category_histories, tasks)):
+                history = History.from_arrays(*arrays)
+                self.evt_histories[event_category.tla] = history
+                LOG.message('{}: {} events, {} features'.format(event_category.full_name, num_events, len(history.features)))
         
     def read_kwd_features(self, output_dir):
         filename = output_dir / 'kwd_features.csv'
         if PAR.KEYWORD_SELECTOR == 'WORD2VEC':
             LOG.enter('Reading word2vec model')
             LOG.message('From {}'.format(filename))
-            self.kwd_vectors = dict()  # (keyword, postag) => vector
-            with CSV.FileReader(filename) as source:
-                assert next(source) == ['KEYWORD', 'POSTAG', 'VECTOR*']
-                for row in source:
-                    keyword = row[0]
-                    postag = row[1]
-                    vector = row[2:]
-                    vector = numpy.array(vector, dtype='float64')
-                    self.kwd_vectors[(keyword, postag)] = vector
+            basename = self.compile_kwd_vectors(filename)
+            self.kwd_vectors = EMB.Embedding(basename)  # 'keyword:postag' => row of self.kwd_vectors.vectors
             LOG.message('{} keywords'.format(len(self.kwd_vectors)))
-            LOG.message('{} dimensions'.format(len(vector)))
+            LOG.message('{} dimensions'.format(self.kwd_vectors.dimensions))
             LOG.leave()
         else:
             LOG.enter('Reading keyword features')
             LOG.message('From {}'.format(filename))
-            self.kwd_features = set()  # (keyword, postag) pairs
+            features = set()  # 'keyword:postag'
             with CSV.FileReader(filename) as source:
                 assert next(source) == ['KEYWORD', 'POSTAG']
                 for row in source:
                     keyword = row[0]
                     postag = row[1]
-                    self.kwd_features.add((keyword, postag))
+                    features.add('{}:{}'.format(keyword, postag))
+            self.kwd_features = VOC.Vocabulary(sorted(features))  # 'keyword:postag' => column
             LOG.message('{} keywords'.format(len(self.kwd_features)))
             LOG.leave()            
     
+    # Compiles kwd_features.csv into a memory-mapped embedding (see support/embedding.py),
+    # named after a hash of the file's contents, so that all experiments with the
+    # same keyword features share one compiled matrix.
+    def compile_kwd_vectors(self, filename):
+        with open(str(filename), 'rb') as source:
+            digest = hashlib.sha1(source.read()).hexdigest()
+        basename = CFG.PHASE3_DIR / 'Temp' / 'kwd_vectors_{}'.format(digest)
+        if EMB.exists(basename):
+            LOG.message('Compiled as {}'.format(basename))
+        else:
+            LOG.message('Compiling to {}'.format(basename))
+            keys, vectors = [], []
+            with CSV.FileReader(filename) as source:
+                assert next(source) == ['KEYWORD', 'POSTAG', 'VECTOR*']
+                for row in source:
+                    keys.append('{}:{}'.format(row[0], row[1]))
+                    vectors.append(numpy.array(row[2:], dtype='float64'))
+            basename.parent.mkdir(parents=True, exist_ok=True)
+            EMB.write(basename, keys, vectors)
+        return basename
+
     def read_evt_features(self, tla, output_dir):
         LOG.enter('Reading event features')
         filename = output_dir / '{}_features.csv'.format(tla)
@@ -101,7 +184,7 @@ class HistoryGenerator:
                 features.add(event)
         LOG.message('{} features'.format(len(features)))
         LOG.leave()
-        self.evt_features[tla] = features
+        self.evt_features[tla] = VOC.Vocabulary(sorted(features))  # 'tla:event' => column
         
     def read_pat_data(self, subcorpus):
         LOG.enter('Reading patient data')
@@ -110,173 +193,371 @@ class HistoryGenerator:
         with CSV.FileReader(filename) as source:
             assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEEFTIJD', 'GESLACHT']
             self.pat_data = {(praktijk_id, patient_id): (leeftijd, geslacht) for praktijk_id, patient_id, leeftijd, geslacht in source}
+        self.patients = VOC.Vocabulary(self.pat_data)  # (praktijk, patient) => patient number
+        self.pat_filename = filename
         LOG.leave()
         
     def read_kwd_data(self, subcorpus):
         filename = CFG.PHASE1_DIR / 'Keywords' / '{}_kwd.csv'.format(subcorpus)
         LOG.message('Reading {}'.format(filename))
-        self.kwd_data = defaultdict(list)  # (praktijk, patient) => list of (days_to_live, lemma, postag) triples
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG']
-            for praktijk_id, patient_id, days_to_live, lemma, postag in source:
-                days_to_live = int(days_to_live)
-                self.kwd_data[(praktijk_id, patient_id)].append((days_to_live, lemma, postag))
+        self.kwd_data = self.read_event_table(filename, KWD_HEADERS, kwd_value)
         
     def read_evt_data(self, tla, subcorpus):
-        data = defaultdict(list)  # (praktijk, patient) => list of (days_to_live, event) pairs
         filename = CFG.PHASE1_DIR / 'Events' / '{}_{}.csv'.format(subcorpus, tla)
         LOG.message('Reading {}'.format(filename))
+        self.evt_data[tla] = self.read_event_table(filename, EVT_HEADERS, evt_value)
+        LOG.message('{} events'.format(self.evt_data[tla].counts.sum()))
+
+    # Reads a Phase 1 file with one event per row as a daily base table: the
+    # number of events per patient, day and value (see EventTable.per_day()).
+    # The histories for any period length are derived from this table, so it
+    # is cached in Phase3/Temp, and reread from there as long as it is newer
+    # than the Phase 1 file and the patient file.
+    def read_event_table(self, filename, headers, value_of_row):
+        cache_name = CFG.PHASE3_DIR / 'Temp' / '{}_days.npz'.format(filename.stem)
+        source_time = max(os.path.getmtime(str(filename)), os.path.getmtime(str(self.pat_filename)))
+        if cache_name.is_file() and os.path.getmtime(str(cache_name)) > source_time:
+            LOG.message('From {}'.format(cache_name))
+            return EventTable.read(cache_name)
         with CSV.FileReader(filename) as source:
-            assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'EVENT']
-            for praktijk_id, patient_id, days_to_live, event in source:
-                days_to_live = int(days_to_live)
-                data[(praktijk_id, patient_id)].append((days_to_live, event))
-        self.evt_data[tla] = data
-        LOG.message('{} events'.format(len(data)))
-        
+            assert next(source) == headers
+            table = self.event_table(source, value_of_row).per_day()
+        LOG.message('Caching to {}'.format(cache_name))
+        cache_name.parent.mkdir(parents=True, exist_ok=True)
+        table.write(cache_name)
+        return table
+
+    # Converts rows of a Phase 1 file to integer columns. Events of patients
+    # without patient data get patient number -1.
+    def event_table(self, rows, value_of_row):
+        values = VOC.Vocabulary()
+        patients, days_to_live, value_ids = array('i'), array('i'), array('i')
+        for row in rows:
+            patients.append(self.patients.index.get((row[0], row[1]), -1))
+            days_to_live.append(int(row[2]))
+            value_ids.append(values.encode(value_of_row(row)))
+        return EventTable(patients, days_to_live, value_ids, values.words)
+
+    # The history row of every event (patient * PAR.HISTORY_LENGTH + period),
+    # or -1 for events outside the history. Rows of the same period are summed
+    # by count_histories(), which turns a daily table into periods.
+    def history_rows(self, table):
+        periods = table.days_to_live // PAR.PERIOD_LENGTH
+        inside = (table.patients >= 0) & (periods >= 0) & (periods < PAR.HISTORY_LENGTH)
+        return numpy.where(inside, table.patients * PAR.HISTORY_LENGTH + periods, -1)
+
     def create_pat_histories(self):
         LOG.enter('Creating histories')
-        self.pat_histories = defaultdict(lambda: [dict() for _ in range(PAR.HISTORY_LENGTH)])
-        for (praktijk_id, patient_id), (age_of_death, geslacht) in self.pat_data.items():
-            for period in range(PAR.HISTORY_LENGTH):
-                vector = self.pat_histories[(praktijk_id, patient_id)][period]
-                vector['age'] = (12 * float(age_of_death) - period) / 1440.0   # Max age for humans is 1440 months (120 years)
-                vector['geslacht'] = -1 if geslacht == 'M' else +1 if geslacht == 'V' else 0
+        self.build_pat_histories()
         LOG.message('{} patients'.format(len(self.pat_data)))
         LOG.leave()
+
+    def build_pat_histories(self):
+        ages = numpy.array([float(leeftijd) for leeftijd, geslacht in self.pat_data.values()])
+        periods = numpy.arange(PAR.HISTORY_LENGTH)
+        self.pat_ages = (12 * ages[:, numpy.newaxis] - periods) / 1440.0  # Max age for humans is 1440 months (120 years)
+        self.pat_genders = [-1 if geslacht == 'M' else +1 if geslacht == 'V' else 0 for leeftijd, geslacht in self.pat_data.values()]
         
     def create_kwd_histories(self):
         LOG.enter('Creating histories')
+        self.kwd_histories = self.build_kwd_histories(self.kwd_data)
+        LOG.leave()
+
+    def build_kwd_histories(self, data):
+        rows = self.history_rows(data)
+        num_rows = len(self.patients) * PAR.HISTORY_LENGTH
+        labels = data.values  # 'lemma:postag'
         if PAR.KEYWORD_SELECTOR == 'WORD2VEC':
-            dimensions = PAR.KEYWORD_TOP
-            self.kwd_histories = defaultdict(lambda: [numpy.zeros(dimensions) for _ in range(PAR.HISTORY_LENGTH)])
-            # Count
-            for (praktijk_id, patient_id), data in self.kwd_data.items():
-                for (days_to_live, lemma, postag) in data:
-                    if (lemma, postag) in self.kwd_vectors:
-                        period = days_to_live // PAR.PERIOD_LENGTH
-                        if 0 <= period < PAR.HISTORY_LENGTH:
-                            #keyword_postag = '{}:{}'.format(lemma, postag)
-                            vector = self.kwd_vectors[lemma, postag]            
-                            self.kwd_histories[(praktijk_id, patient_id)][period] += vector
-            # Scale
-            for periods in self.kwd_histories.values():
-                for vector in periods:
-                    scale = max(max(vector), -min(vector))
-                    if scale:
-                        vector /= scale
+            # Count the keywords per period, then sum their vectors with one matrix product
+            vectors = self.kwd_vectors.vectors
+            columns = self.kwd_vectors.rows(labels)[data.value_ids]
+            matrix = count_histories(rows, columns, data.counts, (num_rows, len(self.kwd_vectors))) @ vectors
+            # Scale each period by its largest absolute value
+            scale = numpy.abs(matrix).max(axis=1, keepdims=True)
+            numpy.divide(matrix, scale, out=matrix, where=scale > 0)
+            return History(['dim{}'.format(dim) for dim in range(vectors.shape[1])], dense_to_csr(matrix))
         else:
-            self.kwd_histories = defaultdict(lambda: [Counter() for _ in range(PAR.HISTORY_LENGTH)])
-            # Count
-            for (praktijk_id, patient_id), data in self.kwd_data.items():
-                for (days_to_live, lemma, postag) in data:
-                    if (lemma, postag) in self.kwd_features:
-                        period = days_to_live // PAR.PERIOD_LENGTH
-                        if 0 <= period < PAR.HISTORY_LENGTH:
-                            keyword_postag = '{}:{}'.format(lemma, postag)
-                            self.kwd_histories[(praktijk_id, patient_id)][period][keyword_postag] += 1
-            # Scale
-            for periods in self.kwd_histories.values():
-                for counter in periods:
-                    if counter:
-                        max_freq = max(counter.values())
-                        for keyword, freq in counter.items():
-                            counter[keyword] /= max_freq
-        LOG.leave()
+            features = self.kwd_features
+            columns = feature_columns(features, labels)[data.value_ids]
+            matrix = count_histories(rows, columns, data.counts, (num_rows, len(features)))
+            scale_rows(matrix)
+            return History(features.words, matrix)
 
     def create_evt_histories(self, tla):
         LOG.enter('Creating histories')
-        data = self.evt_data[tla]
-        features = self.evt_features[tla]
-        histories = defaultdict(lambda: [Counter() for _ in range(PAR.HISTORY_LENGTH)])
         level = getattr(PAR, '{}_LEVEL'.format(tla.upper()))
         LOG.message('Aggregating to {} level'.format(level))
-        # Count events per patient and per period
-        for (praktijk, patient), evt_data in data.items():
-            for (days_to_live, event) in evt_data:
-                if tla == 'icd':
-                    event = self.icd_mapping[event][level]
-                if tla in {'ana', 'dia', 'int', 'rfe'}:
-                    event = self.icpc_mapping[event][level]                
-                event = '{}:{}'.format(tla, event)
-                if event in features:
-                    period = days_to_live // PAR.PERIOD_LENGTH
-                    if 0 <= period < PAR.HISTORY_LENGTH:
-                        histories[(praktijk, patient)][period][event] += 1
-        # For each event category, each patient, and each period, scale the event counts to the range 0 ≤ count ≤ 1
-        for periods in histories.values():
-            for counter in periods:
-                if counter:
-                    max_freq = max(counter.values())
-                    for event, freq in counter.items():
-                        counter[event] /= max_freq
-        self.evt_histories[tla] = histories
+        self.evt_histories[tla] = self.build_evt_histories(tla, self.evt_data[tla])
         LOG.leave()
 
+    def build_evt_histories(self, tla, data):
+        level = getattr(PAR, '{}_LEVEL'.format(tla.upper()))
+        hierarchy = code_hierarchy.of_category(tla)
+        if hierarchy:
+            names = hierarchy.names[level]
+            events = [names[level_id] for level_id in hierarchy.level_ids(hierarchy.encode(data.values), level).tolist()]
+        else:
+            events = data.values
+        features = self.evt_features[tla]
+        columns = feature_columns(features, ['{}:{}'.format(tla, event) for event in events])[data.value_ids]
+        # Count events per patient and per period, and scale the counts to the range 0 ≤ count ≤ 1
+        matrix = count_histories(self.history_rows(data), columns, data.counts, (len(self.patients) * PAR.HISTORY_LENGTH, len(features)))
+        scale_rows(matrix)
+        return History(features.words, matrix)
+
+    # Writes the histories as a CSV file and, with the same name, as a binary
+    # history file (see support/history_file.py).
     def write_histories(self, output_dir, filename):
         LOG.enter('Writing histories')
         filename = output_dir / filename
         LOG.message('To {}'.format(filename))
-        with CSV.FileWriter(filename) as target:
-            headers = ['PRAKTIJK-ID', 'PATIENT-ID'] + ['P{0}'.format(period) for period in range(PAR.HISTORY_LENGTH)]
-            target.writerow(headers)
-            for (praktijk_id, patient_id) in self.pat_data:
-                row = [praktijk_id, patient_id]
-                for period in range(PAR.HISTORY_LENGTH):
-                    features = []
-                    # Patients
-                    pat_features = self.pat_histories[(praktijk_id, patient_id)][period]
-                    for feature, value in pat_features.items():
-                        features.append((feature, value))
-                    # Keywords
-                    if PAR.INCLUDE_KEYWORDS:
-                        if PAR.KEYWORD_SELECTOR == 'WORD2VEC':
-                            vector = self.kwd_histories[(praktijk_id, patient_id)][period]
-                            for dim, value in enumerate(vector):
-                                feature = 'dim{}'.format(dim)
-                                features.append((feature, value))
-                        else:
-                            kwd_features = self.kwd_histories[(praktijk_id, patient_id)][period]
-                            for feature, value in kwd_features.items():
-                                features.append((feature, value))
-                    # Events
-                    for tla, data in self.evt_histories.items():
-                        evt_features = data[(praktijk_id, patient_id)][period]
-                        for feature, value in evt_features.items():
-                            features.append((feature, value))
-                    # Write features
-                    if len(features) == 2:  # Write nothing if only age and gender are present
-                        features = ''
-                    else:
-                        features = ','.join('{}={}'.format(feature, value) for feature, value in features)
-                    row.append(features)
-                target.writerow(row)
+        # The CSV file is closed first, so the binary file is never older than it
+        with HF.Writer(filename.with_suffix('.npz')) as binary, CSV.FileWriter(filename) as target:
+            self.write_headers(target)
+            self.write_rows(target, binary)
             LOG.message('{} periods of {} days each'.format(PAR.HISTORY_LENGTH, PAR.PERIOD_LENGTH))
             LOG.message('{} histories'.format(len(self.pat_data)))
         LOG.leave()
 
-    def read_icd_mapping(self):
-        LOG.enter('Reading ICD mapping')
-        filename = CFG.DATA_DIR / 'icd.csv'
-        LOG.message('From {}'.format(filename))
-        self.icd_mapping = dict()
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['CODE', 'SUB-CAT', 'MAIN-CAT']
-            for code, sub_cat, main_cat in source:
-                self.icd_mapping[code] = {'CODE': code, 'SUB-CAT': sub_cat, 'MAIN-CAT': main_cat}        
-        LOG.leave()
-    
-    def read_icpc_mapping(self):
-        LOG.enter('Reading ICPC mapping')
-        filename = CFG.DATA_DIR / 'icpc.csv'
-        LOG.message('From {}'.format(filename))
-        self.icpc_mapping = dict()
-        with CSV.FileReader(filename) as source:
-            assert next(source) == ['CODE', 'SUB-CAT', 'MAIN-CAT', 'COLOR']
-            for code, sub_cat, main_cat, color in source:
-                self.icpc_mapping[code] = {'CODE': code, 'SUB-CAT': sub_cat, 'MAIN-CAT': main_cat, 'COLOR': color}        
-        LOG.leave()
- 
+    def write_headers(self, target):
+        headers = ['PRAKTIJK-ID', 'PATIENT-ID'] + ['P{0}'.format(period) for period in range(PAR.HISTORY_LENGTH)]
+        target.writerow(headers)
+
+    # Writes the histories of the patients in self.patients.
+    def write_rows(self, target, binary):
+        histories = self.feature_histories()
+        item_lists = [history.item_lists() for history in histories]
+        for patient, (praktijk_id, patient_id) in enumerate(self.patients.words):
+            row = [praktijk_id, patient_id]
+            for period in range(PAR.HISTORY_LENGTH):
+                history_row = patient * PAR.HISTORY_LENGTH + period
+                features = []
+                for items in item_lists:
+                    features.extend(items(history_row))
+                # Write nothing if only age and gender are present
+                if features:
+                    features.insert(0, 'age={}'.format(self.pat_ages[patient, period]))
+                    features.insert(1, 'geslacht={}'.format(self.pat_genders[patient]))
+                row.append(','.join(features))
+            target.writerow(row)
+        binary.write(self.combine_histories(histories))
+
+    # The keyword and event histories, in the order in which they are written.
+    def feature_histories(self):
+        histories = list(self.evt_histories.values())
+        if PAR.INCLUDE_KEYWORDS:
+            histories.insert(0, self.kwd_histories)
+        return histories
+
+    # Combines the patient data and the keyword and event histories into one
+    # matrix, with the same items per period as the CSV file: age and gender
+    # only in periods with other features.
+    def combine_histories(self, histories):
+        num_rows = len(self.patients) * PAR.HISTORY_LENGTH
+        lengths = sum((numpy.diff(history.matrix.indptr) for history in histories), numpy.zeros(num_rows, dtype='int64'))
+        filled = lengths > 0
+        ages = self.pat_ages.reshape(-1)[filled]
+        genders = numpy.repeat(self.pat_genders, PAR.HISTORY_LENGTH)[filled]
+        pat_indptr = numpy.concatenate([[0], numpy.cumsum(2 * filled)])
+        pat_indices = numpy.tile([0, 1], len(ages))
+        pat_data = numpy.column_stack([ages, genders]).reshape(-1)
+        pat_matrix = scipy.sparse.csr_matrix((pat_data, pat_indices, pat_indptr), shape=(num_rows, 2))
+        features = ['age', 'geslacht'] + [feature for history in histories for feature in history.features]
+        matrix = scipy.sparse.hstack([pat_matrix] + [history.matrix for history in histories], format='csr')
+        return HF.Histories(self.patients.words, features, matrix, PAR.HISTORY_LENGTH)
+
+
+KWD_HEADERS = ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG']
+EVT_HEADERS = ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'EVENT']
+
+
+def kwd_value(row):
+    return '{}:{}'.format(row[3], row[4])  # lemma:postag
+
+
+def evt_value(row):
+    return row[3]
+
+
+# A Phase 1 file, indexed by patient, so that the rows of one patient can be
+# read at a time. The rows of a patient need not be consecutive: the keyword
+# files, for instance, list all brieven before all notities. A single pass
+# over the file records the byte range of every run of rows of the same
+# patient, and rows() reads back just those ranges. Rows of patients not in
+# patients (a Vocabulary) are left out.
+class PatientFile:
+
+    def __init__(self, filename, headers, patients):
+        self.filename = str(filename)
+        self.headers = headers
+        self.patients = patients
+
+    def __enter__(self):
+        self.data_file = open(self.filename, 'rb')
+        header = self.data_file.readline()
+        assert next(csv.reader([header.decode('utf-8-sig')], delimiter=';')) == self.headers
+        self.runs = dict()  # (praktijk, patient) => [(begin, end)] byte ranges
+        offset = len(header)
+        run_key, run_begin = None, offset
+        for line in self.data_file:
+            key = line[:line.find(b';', line.find(b';') + 1)]  # The praktijk and patient fields
+            if key != run_key:
+                self.add_run(run_key, run_begin, offset)
+                run_key, run_begin = key, offset
+            offset += len(line)
+        self.add_run(run_key, run_begin, offset)
+        return self
+
+    def __exit__(self, *args):
+        self.data_file.close()
+
+    def add_run(self, key, begin, end):
+        if key is None: return
+        patient = tuple(next(csv.reader([key.decode('utf-8')], delimiter=';')))
+        if patient in self.patients.index:
+            self.runs.setdefault(patient, []).append((begin, end))
+
+    # Returns the rows of a patient, in the order of the file.
+    def rows(self, patient):
+        rows = []
+        for begin, end in self.runs.get(patient, ()):
+            self.data_file.seek(begin)
+            # Split on b'\n' only, like the csv module: str.splitlines would also
+            # split on characters such as '\x85' and '\u2028' within fields.
+            lines = self.data_file.read(end - begin).split(b'\n')[:-1]
+            rows.extend(csv.reader([line.removesuffix(b'\r').decode('utf-8') for line in lines], delimiter=';'))
+        return rows
+
+
+# Events from a Phase 1 file as integer columns. The value of an event is
+# values[value_id], and counts holds the number of such events.
+class EventTable:
+
+    def __init__(self, patients, days_to_live, value_ids, values, counts=None):
+        self.patients = numpy.array(patients, dtype='int64')
+        self.days_to_live = numpy.array(days_to_live, dtype='int64')
+        self.value_ids = numpy.array(value_ids, dtype='int64')
+        self.values = values
+        self.counts = numpy.ones(len(self.value_ids), dtype='int64') if counts is None else numpy.array(counts, dtype='int64')
+
+    def __len__(self):
+        return len(self.value_ids)
+
+    # Returns the table with one entry per patient, day and value, leaving out
+    # the events that fall outside every history (unknown patients, negative
+    # days to live).
+    def per_day(self):
+        keep = (self.patients >= 0) & (self.days_to_live >= 0)
+        patients, days_to_live, value_ids, counts = self.patients[keep], self.days_to_live[keep], self.value_ids[keep], self.counts[keep]
+        order = numpy.lexsort((value_ids, days_to_live, patients))
+        patients, days_to_live, value_ids, counts = patients[order], days_to_live[order], value_ids[order], counts[order]
+        changes = (numpy.diff(patients) != 0) | (numpy.diff(days_to_live) != 0) | (numpy.diff(value_ids) != 0)
+        starts = numpy.concatenate([[0], numpy.flatnonzero(changes) + 1]) if len(order) else numpy.zeros(0, dtype='int64')
+        counts = numpy.add.reduceat(counts, starts) if len(order) else counts
+        return EventTable(patients[starts], days_to_live[starts], value_ids[starts], self.values, counts)
+
+    def write(self, filename):
+        # numpy.savez appends .npz to names that lack it, so write through a file object.
+        temp_name = str(filename) + '.tmp'
+        with open(temp_name, 'wb') as target:
+            numpy.savez(target,
+                        patients=self.patients.astype('int32'),
+                        days_to_live=self.days_to_live.astype('int32'),
+                        value_ids=self.value_ids.astype('int32'),
+                        counts=self.counts.astype('int32'),
+                        values=numpy.array(self.values, dtype=str))
+        os.replace(temp_name, str(filename))
+
+    @staticmethod
+    def read(filename):
+        with numpy.load(str(filename)) as data:
+            return EventTable(data['patients'], data['days_to_live'], data['value_ids'], data['values'].tolist(), data['counts'])
+
+
+# The histories of all patients for one group of features. The matrix is a
+# CSR matrix with a row per patient and period (patient * PAR.HISTORY_LENGTH
+# + period) and a column per feature. Its stored values are the items that
+# are written, including those with value 0.
+class History:
+
+    def __init__(self, features, matrix):
+        self.features = features
+        self.matrix = matrix
+
+    # Returns a function that gives the 'feature=value' items of a row.
+    def item_lists(self):
+        features = self.features
+        indptr, indices, data = self.matrix.indptr.tolist(), self.matrix.indices.tolist(), self.matrix.data.tolist()
+        return lambda row: ['{}={}'.format(features[column], value) for column, value in zip(indices[indptr[row]:indptr[row + 1]], data[indptr[row]:indptr[row + 1]])]
+
+    # The history as plain arrays, which pickle compactly, for passing it
+    # between processes.
+    def to_arrays(self):
+        return self.features, self.matrix.shape, self.matrix.data, self.matrix.indices, self.matrix.indptr
+
+    @staticmethod
+    def from_arrays(features, shape, data, indices, indptr):
+        return History(features, scipy.sparse.csr_matrix((data, indices, indptr), shape=shape))
+
+
+_category_generator = None  # The HistoryGenerator of a worker process of run_events_parallel
+
+
+def init_category_worker(parameters, patients, pat_filename):
+    global _category_generator
+    for key, value in parameters.items():
+        setattr(PAR, key, value)
+    LOG.levels = -1  # Only the main process logs
+    _category_generator = HistoryGenerator()
+    _category_generator.patients = patients
+    _category_generator.pat_filename = pat_filename
+    _category_generator.evt_features = dict()
+    _category_generator.evt_data = dict()
+
+
+# Worker for HistoryGenerator.run_events_parallel. Returns the number of events
+# and the histories of one event category, as History.to_arrays().
+def build_category_histories(task):
+    tla, output_dir, subcorpus = task
+    generator = _category_generator
+    generator.read_evt_features(tla, output_dir)
+    generator.read_evt_data(tla, subcorpus)
+    data = generator.evt_data.pop(tla)
+    return int(data.counts.sum()), generator.build_evt_histories(tla, data).to_arrays()
+
+
+# Returns the column of every label in features (a Vocabulary), or -1 for
+# labels that are not a feature.
+def feature_columns(features, labels):
+    return numpy.array([features.index.get(label, -1) for label in labels], dtype='int64')
+
+
+# Adds up the counts of the (row, column) pairs into a CSR matrix of the given
+# shape, leaving out pairs with a negative row or column.
+def count_histories(rows, columns, counts, shape):
+    keep = (rows >= 0) & (columns >= 0)
+    counts = counts[keep].astype('float64')
+    return scipy.sparse.csr_matrix((counts, (rows[keep], columns[keep])), shape=shape)  # Duplicates are summed
+
+
+# Converts a dense array to a CSR matrix that stores every value, including
+# zeros, so that every feature is written for every period.
+def dense_to_csr(matrix):
+    num_rows, num_columns = matrix.shape
+    indptr = numpy.arange(0, num_rows * num_columns + 1, num_columns)
+    indices = numpy.tile(numpy.arange(num_columns), num_rows)
+    return scipy.sparse.csr_matrix((matrix.reshape(-1), indices, indptr), shape=matrix.shape)
+
+
+# Divides the values in every row of a CSR matrix by the largest value in that
+# row, in place.
+def scale_rows(matrix):
+    if matrix.nnz:
+        lengths = numpy.diff(matrix.indptr)
+        filled = lengths > 0
+        maxima = numpy.maximum.reduceat(matrix.data, matrix.indptr[:-1][filled])
+        matrix.data /= numpy.repeat(maxima, lengths[filled])
+
 
 # Main program
 if __name__ == '__main__':
@@ -4,6 +4,9 @@ from support import logging as LOG
 from support import parameters as PAR
 
 import epd_corpus
+import multiprocessing
+import os
+import shutil
 import unicodedata
 import re
 
@@ -18,9 +21,19 @@ class Text:
         # Data
         self.text = ' '.join(text.lower().split())
 
+    # Maps every non-ASCII character seen so far to its NFKD form without
+    # combining characters. Decomposition works character by character, so
+    # translating with this table equals normalizing the whole text.
+    diacriticals = {}
+
     def drop_diacriticals(self):
-        nfkd_form = unicodedata.normalize('NFKD', self.text)
-        self.text = ''.join(c for c in nfkd_form if not unicodedata.combining(c))
+        if self.text.isascii(): return
+        table = Text.diacriticals
+        for c in set(self.text):
+            if ord(c) >= 128 and ord(c) not in table:
+                nfkd_form = unicodedata.normalize('NFKD', c)
+                table[ord(c)] = ''.join(d for d in nfkd_form if not unicodedata.combining(d))
+        self.text = self.text.translate(table)
 
     def as_tuple(self):
         return self.praktijk_id, self.patient_id, self.levensverwachting, self.text
@@ -63,61 +76,88 @@ class TextExtractor:
     def run(self):
         LOG.enter(self.__class__.__name__ + '.run()')        
         LOG.enter('development set')
-        self.corpus = epd_corpus.read(epd_corpus.DataSet.DEVELOPMENT)
-        self.extract_texts()
-        self.write_texts('dev')
+        self.extract_texts(epd_corpus.DataSet.DEVELOPMENT, 'dev')
         LOG.leave()
         LOG.enter('validation set')
-        self.corpus = epd_corpus.read(epd_corpus.DataSet.VALIDATION)
-        self.extract_texts()
-        self.write_texts('val')
+        self.extract_texts(epd_corpus.DataSet.VALIDATION, 'val')
         LOG.leave()        
         LOG.leave()
 
-    def extract_texts(self):
+    # Extracts and writes the texts one praktijk at a time, in PAR.PROCESSES
+    # worker processes. Only the texts of the praktijken in progress are held
+    # in memory. All brieven precede all notities in the output, so the
+    # notities are spilled to a temporary file and appended at the end.
+    def extract_texts(self, data_set, name):
         LOG.enter('extracting texts')
-        # Brieven
-        brieven = self.extract_brieven()
-        LOG.message('{} characters in {} brieven'.format(sum(len(brief.text) for brief in brieven), len(brieven)))
-        # Notities
-        notities = self.extract_notities()
-        LOG.message('{} characters in {} notities'.format(sum(len(notitie.text) for notitie in notities), len(notities)))
-        #
-        self.texts = brieven + notities
+        LOG.message('from {}'.format(CFG.CORPUS_PER_PRAKTIJK_DIR))
+        filename = CFG.PHASE1_DIR / 'Temp' / '{}_texts1.csv'.format(name)
+        spill_filename = CFG.PHASE1_DIR / 'Temp' / '{}_texts1.tmp'.format(name)
+        LOG.message('to {}'.format(filename))
+        tasks = [(ident, data_set) for ident in CFG.PRAKTIJK_IDS]
+        try:
+            if PAR.PROCESSES > 1:
+                with multiprocessing.Pool(PAR.PROCESSES) as pool:
+                    counts = self.write_texts(pool.imap(extract_praktijk_texts, tasks), filename, spill_filename)
+            else:
+                counts = self.write_texts(map(extract_praktijk_texts, tasks), filename, spill_filename)
+            with open(str(filename), 'a', encoding='utf-8') as target, open(str(spill_filename), encoding='utf-8') as spill:
+                shutil.copyfileobj(spill, target)
+        finally:
+            if spill_filename.exists():
+                os.remove(str(spill_filename))
+        brief_count, brief_chars, notitie_count, notitie_chars = counts
+        LOG.message('{} characters in {} brieven'.format(brief_chars, brief_count))
+        LOG.message('{} characters in {} notities'.format(notitie_chars, notitie_count))
+        LOG.message('{} texts'.format(brief_count + notitie_count))
         LOG.leave()
 
-    def extract_brieven(self):
+    # Writes the brieven of every praktijk to filename and its notities to
+    # spill_filename. Returns the numbers of brieven and notities and of their
+    # characters.
+    def write_texts(self, results, filename, spill_filename):
+        brief_count, brief_chars, notitie_count, notitie_chars = 0, 0, 0, 0
+        with CSV.FileWriter(filename) as target, CSV.FileWriter(spill_filename) as spill:
+            target.writerow(['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'TEXT'])
+            for ident, brieven, notities in results:
+                LOG.message('praktijk {}: {} brieven, {} notities'.format(ident, len(brieven), len(notities)))
+                target.writerows(brieven)
+                spill.writerows(notities)
+                brief_count += len(brieven)
+                brief_chars += sum(len(brief[3]) for brief in brieven)
+                notitie_count += len(notities)
+                notitie_chars += sum(len(notitie[3]) for notitie in notities)
+        return brief_count, brief_chars, notitie_count, notitie_chars
+
+    def extract_brieven(self, praktijk):
         brieven = []
-        for praktijk in self.corpus.praktijken:
-            for patient in praktijk.patienten:
-                for contact in patient.contacten:
-                    levensverwachting = (patient.overlijdensdatum - contact.datum).days
-                    for deelcontact in contact.deelcontacten:
-                        for brief in deelcontact.brieven:
-                            brieven.append(Brief(praktijk.ident, patient.ident, levensverwachting, brief.tekst))
+        for patient in praktijk.patienten:
+            for contact in patient.contacten:
+                levensverwachting = (patient.overlijdensdatum - contact.datum).days
+                for deelcontact in contact.deelcontacten:
+                    for brief in deelcontact.brieven:
+                        brieven.append(Brief(praktijk.ident, patient.ident, levensverwachting, brief.tekst))
         return brieven
 
-    def extract_notities(self):
+    def extract_notities(self, praktijk):
         notities = []
-        for praktijk in self.corpus.praktijken:
-            for patient in praktijk.patienten:
-                for contact in patient.contacten:
-                    levensverwachting = (patient.overlijdensdatum - contact.datum).days
-                    for deelcontact in contact.deelcontacten:
-                        for notitie in deelcontact.notities:
-                            notities.append(Notitie(praktijk.ident, patient.ident, levensverwachting, notitie.tekst))
+        for patient in praktijk.patienten:
+            for contact in patient.contacten:
+                levensverwachting = (patient.overlijdensdatum - contact.datum).days
+                for deelcontact in contact.deelcontacten:
+                    for notitie in deelcontact.notities:
+                        notities.append(Notitie(praktijk.ident, patient.ident, levensverwachting, notitie.tekst))
         return notities
-        
-    def write_texts(self, data_set):
-        LOG.enter('writing texts')
-        filename = CFG.PHASE1_DIR / 'Temp' / '{}_texts1.csv'.format(data_set)
-        LOG.message('to {}'.format(filename))
-        with CSV.FileWriter(filename) as target:
-            target.writerow(['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'TEXT'])
-            for text in self.texts:
-                target.writerow(text.as_tuple())
-        LOG.message('{} texts'.format(len(self.texts)))
-        LOG.leave()
+
+
+# Worker for TextExtractor.extract_texts: reads one praktijk and returns its
+# brieven and notities as rows.
+def extract_praktijk_texts(task):
+    ident, data_set = task
+    praktijk = epd_corpus.read_praktijk(ident, data_set)
+    extractor = TextExtractor()
+    brieven = [brief.as_tuple() for brief in extractor.extract_brieven(praktijk)]
+    notities = [notitie.as_tuple() for notitie in extractor.extract_notities(praktijk)]
+    return ident, brieven, notities
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+# A store of patient histories shared by all experiments.
+#   Experiments often differ only in parameters that do not affect the
+# histories, such as the LSTM parameters. The store keeps one copy of the
+# histories per distinct set of inputs of HistoryGenerator, named after a hash
+# of those inputs:
+#   - STORE_VERSION, the version of HistoryGenerator's output,
+#   - the parameters that HistoryGenerator uses (STORE_PARAMETERS and the
+#     event levels of the categories in EVENT_FILTER),
+#   - the contents of the keyword and event feature files of the experiment,
+#   - the size and modification time of the Phase 1 and code hierarchy files.
+# The histories of an experiment are built in the store if they are not there
+# yet (or if rebuild is set), and then hard linked (or, across file systems,
+# copied) into the experiment directory.
+
+from support import config as CFG
+from support import logging as LOG
+from support import parameters as PAR
+
+from get_histories import HistoryGenerator
+
+import hashlib
+import os
+import shutil
+
+
+STORE_DIR = CFG.RESULTS_DIR / 'HistoryStore'
+
+STORE_VERSION = 1  # Increase when HistoryGenerator writes different histories from the same inputs
+
+STORE_PARAMETERS = ('WORKFLOW', 'INCLUDE_KEYWORDS', 'KEYWORD_SELECTOR', 'PERIOD_LENGTH', 'HISTORY_LENGTH', 'EVENT_FILTER')
+
+
+class HistoryStore:
+
+    def run(self, directory, rebuild=False):
+        LOG.enter(self.__class__.__name__ + '.run()')
+        key = self.key(directory)
+        store = STORE_DIR / key
+        if store.is_dir() and not rebuild:
+            LOG.message('Histories found in {}'.format(store))
+        else:
+            LOG.message('Building histories in {}'.format(store))
+            self.build(directory, store, rebuild)
+        for name in self.history_files():
+            target = directory / name
+            if target.is_file():
+                os.remove(str(target))
+            try:
+                os.link(str(store / name), str(target))
+            except OSError:
+                shutil.copy2(str(store / name), str(target))
+        LOG.leave()
+
+    # Builds the histories in a temporary directory next to the store
+    # directory, so that an interrupted build leaves no store directory behind.
+    # When rebuilding, the new directory replaces the old one; experiments
+    # that linked the old histories keep them.
+    def build(self, directory, store, rebuild=False):
+        temp = store.with_name('{}.{}.tmp'.format(store.name, os.getpid()))
+        temp.mkdir(parents=True)
+        try:
+            for name in self.feature_files():
+                shutil.copy2(str(directory / name), str(temp / name))
+            with open(str(temp / 'key.txt'), 'w') as target:
+                target.write(self.key_text(directory))
+            HistoryGenerator().run(temp)
+        except BaseException:
+            shutil.rmtree(str(temp))
+            raise
+        if rebuild and store.is_dir():
+            old = store.with_name('{}.{}.old'.format(store.name, os.getpid()))
+            os.rename(str(store), str(old))
+            shutil.rmtree(str(old))
+        try:
+            os.rename(str(temp), str(store))
+        except OSError:  # Built by another process in the mean time
+            shutil.rmtree(str(temp))
+
+    def key(self, directory):
+        return hashlib.sha1(self.key_text(directory).encode('utf-8')).hexdigest()
+
+    # Everything the histories depend on, one input per line.
+    def key_text(self, directory):
+        lines = ['version {}'.format(STORE_VERSION)]
+        parameters = list(STORE_PARAMETERS) + ['{}_LEVEL'.format(tla.upper()) for tla in PAR.EVENT_FILTER]
+        for name in parameters:
+            lines.append('{} = {!r}'.format(name, getattr(PAR, name)))
+        for name in self.feature_files():
+            with open(str(directory / name), 'rb') as source:
+                lines.append('{} {}'.format(name, hashlib.sha1(source.read()).hexdigest()))
+        for filename in self.source_files():
+            stat = os.stat(str(filename))
+            lines.append('{} {} {}'.format(filename, stat.st_size, stat.st_mtime_ns))
+        return ''.join(line + '\n' for line in lines)
+
+    def feature_files(self):
+        names = ['{}_features.csv'.format(tla) for tla in PAR.EVENT_FILTER]
+        if PAR.INCLUDE_KEYWORDS:
+            names.insert(0, 'kwd_features.csv')
+        return names
+
+    def source_files(self):
+        subcorpora = ['dev', 'val'] if PAR.WORKFLOW == 'VALIDATION' else ['dev']
+        filenames = [CFG.DATA_DIR / 'icd.csv', CFG.DATA_DIR / 'icpc.csv']
+        for subcorpus in subcorpora:
+            filenames.append(CFG.PHASE1_DIR / 'Patients' / '{}_pat.csv'.format(subcorpus))
+            if PAR.INCLUDE_KEYWORDS:
+                filenames.append(CFG.PHASE1_DIR / 'Keywords' / '{}_kwd.csv'.format(subcorpus))
+            for tla in PAR.EVENT_FILTER:
+                filenames.append(CFG.PHASE1_DIR / 'Events' / '{}_{}.csv'.format(subcorpus, tla))
+        return filenames
+
+    # The files written by HistoryGenerator.
+    def history_files(self):
+        basenames = ['train', 'test'] if PAR.WORKFLOW == 'VALIDATION' else ['modeldata']
+        return [basename + extension for basename in basenames for extension in ('.csv', '.npz')]
@@ -0,0 +1,132 @@
+# The Phase 1 keyword file (Keywords/dev_kwd.csv) as integer-coded columns.
+#   Every row of the file becomes one element of each of these NumPy arrays:
+#     keyword_ids   index into keywords (the lemma)
+#     postag_ids    index into postags
+#     patient_ids   index into patients, a list of (praktijk id, patient id) pairs
+#     days_to_live  the LEVENSVERWACHTING column
+# The rows keep their order, so a document is a run of consecutive rows with
+# the same patient and days to live.
+#   Parsing the CSV file is slow, so the table is cached in Phase2/Temp and
+# reread from there as long as it is newer than the CSV file. Within a process
+# the table is read only once.
+
+from support import config as CFG
+from support import my_csv as CSV
+from support import logging as LOG
+from support import vocabulary as VOC
+from support import arff as ARFF
+
+from array import array
+import numpy
+import os
+
+
+_tables = {}  # data set => KeywordTable
+
+
+def read(data_set='dev'):
+    if data_set not in _tables:
+        _tables[data_set] = _KeywordTableReader().run(data_set)
+    return _tables[data_set]
+
+
+class KeywordTable:
+
+    def __len__(self):
+        return len(self.keyword_ids)
+
+    def periods(self, period_length):
+        return self.days_to_live // period_length
+
+    # Index of the first row of every document, followed by the number of rows.
+    def document_bounds(self):
+        changes = (numpy.diff(self.patient_ids) != 0) | (numpy.diff(self.days_to_live) != 0)
+        return numpy.concatenate([[0], numpy.flatnonzero(changes) + 1, [len(self)]])
+
+    # Numbers every possible (keyword, postag) pair, for counting pairs.
+    def pair_ids(self):
+        return self.keyword_ids.astype('int64') * len(self.postags) + self.postag_ids
+
+    def pair(self, pair_id):
+        return self.keywords[pair_id // len(self.postags)], self.postags[pair_id % len(self.postags)]
+
+    # Returns 'lemma:postag' for every row.
+    def labels(self):
+        pair_ids, inverse = numpy.unique(self.pair_ids(), return_inverse=True)
+        pair_labels = numpy.array(['{}:{}'.format(*self.pair(pair_id)) for pair_id in pair_ids], dtype=object)
+        return pair_labels[inverse.ravel()]
+
+    # Writes the rows as sparse ARFF instances (see support/arff.py), where
+    # attribute i counts the occurrences of the pair attribute_pairs[i].
+    def write_arff_data(self, target, attribute_pairs):
+        columns = numpy.full(len(self.keywords) * len(self.postags), -1)
+        columns[numpy.asarray(attribute_pairs, dtype='int64')] = numpy.arange(len(attribute_pairs))
+        return ARFF.write_sparse_data(target, self.patient_ids, self.days_to_live, columns[self.pair_ids()], len(attribute_pairs))
+
+
+class _KeywordTableReader:
+
+    def run(self, data_set):
+        LOG.enter('Reading keyword table')
+        source_name = CFG.PHASE1_DIR / 'Keywords' / '{}_kwd.csv'.format(data_set)
+        cache_name = CFG.PHASE2_DIR / 'Temp' / '{}_kwd.npz'.format(data_set)
+        if cache_name.is_file() and os.path.getmtime(str(cache_name)) > os.path.getmtime(str(source_name)):
+            LOG.message('From {}'.format(cache_name))
+            table = self.read_cache(cache_name)
+        else:
+            LOG.message('From {}'.format(source_name))
+            table = self.read_csv(source_name)
+            LOG.message('Caching to {}'.format(cache_name))
+            self.write_cache(cache_name, table)
+        LOG.message('{} keyword events, {} unique keywords, {} postags, {} patients'.format(len(table), len(table.keywords), len(table.postags), len(table.patients)))
+        LOG.leave()
+        return table
+
+    def read_csv(self, filename):
+        keywords, postags, patients = VOC.Vocabulary(), VOC.Vocabulary(), VOC.Vocabulary()
+        keyword_ids, postag_ids, patient_ids, days_to_live = array('i'), array('i'), array('i'), array('i')
+        with CSV.FileReader(filename) as source:
+            assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG']
+            for praktijk_id, patient_id, days, keyword, postag in source:
+                keyword_ids.append(keywords.encode(keyword))
+                postag_ids.append(postags.encode(postag))
+                patient_ids.append(patients.encode((praktijk_id, patient_id)))
+                days_to_live.append(int(days))
+        table = KeywordTable()
+        table.keywords = keywords.words
+        table.postags = postags.words
+        table.patients = patients.words
+        table.keyword_ids = numpy.array(keyword_ids, dtype='int32')
+        table.postag_ids = numpy.array(postag_ids, dtype='int32')
+        table.patient_ids = numpy.array(patient_ids, dtype='int32')
+        table.days_to_live = numpy.array(days_to_live, dtype='int32')
+        return table
+
+    # Writes to a temporary file first, so an interrupted write cannot leave a
+    # truncated cache that is newer than the CSV file.
+    def write_cache(self, filename, table):
+        temp_name = str(filename) + '.tmp'
+        # numpy.savez appends .npz to names that lack it, so write through a file object.
+        with open(temp_name, 'wb') as target:
+            numpy.savez(target,
+                        keywords=numpy.array(table.keywords, dtype=str),
+                        postags=numpy.array(table.postags, dtype=str),
+                        praktijk_ids=numpy.array([praktijk_id for praktijk_id, patient_id in table.patients], dtype=str),
+                        patient_ids=numpy.array([patient_id for praktijk_id, patient_id in table.patients], dtype=str),
+                        keyword_column=table.keyword_ids,
+                        postag_column=table.postag_ids,
+                        patient_column=table.patient_ids,
+                        days_column=table.days_to_live)
+        os.replace(temp_name, str(filename))
+
+    def read_cache(self, filename):
+        with numpy.load(str(filename)) as data:
+            table = KeywordTable()
+            table.keywords = data['keywords'].tolist()
+            table.postags = data['postags'].tolist()
+            table.patients = list(zip(data['praktijk_ids'].tolist(), data['patient_ids'].tolist()))
+            table.keyword_ids = data['keyword_column']
+            table.postag_ids = data['postag_column']
+            table.patient_ids = data['patient_column']
+            table.days_to_live = data['days_column']
+        return table
@@ -6,6 +6,9 @@ from support import parameters as PAR
 import epd_corpus
 import unicodedata
 from collections import Counter
+from functools import lru_cache
+from itertools import chain
+import multiprocessing
 import re
 
 
@@ -25,13 +28,49 @@ INITIALISM = re.compile(r'( |\A)([a-z]\.){2,}( |\Z)')   # ' d.w.z.'
 # Tokens are further split at full stops, dashes and underscores.
 SEPARATOR = re.compile('[-_\.]')
 
+# Affixes without any of these characters are plain strings rather than regexes.
+REGEX_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+# Number of sublemmas remembered by Lemmatizer.sublemmatize.
+LEMMA_CACHE_SIZE = 1 << 20
+
+
+# Finds which of a list of affixes a word starts with (or, if reverse is set,
+# ends with) in a single walk over the word. When several affixes match, the
+# one listed first wins, just as when trying the affixes in turn.
+class AffixTrie:
+
+    def __init__(self, affixes, reverse=False):
+        self.root = {}  # char => node; None => index of the affix ending here
+        self.reverse = reverse
+        for index, affix in affixes:
+            node = self.root
+            for char in (reversed(affix) if reverse else affix):
+                node = node.setdefault(char, {})
+            node.setdefault(None, index)  # Keep the first of duplicate affixes
+
+    # Returns the index of the first matching affix, or None.
+    def first_match(self, word):
+        node = self.root
+        best = node.get(None)
+        for char in (reversed(word) if self.reverse else word):
+            node = node.get(char)
+            if node is None: break
+            index = node.get(None)
+            if index is not None and (best is None or index < best):
+                best = index
+        return best
+
 
 class Lemmatizer:
 
     def run(self):
         LOG.enter(self.__class__.__name__ + '.run()')
-        self.corpus = epd_corpus.read(epd_corpus.DataSet.DEVELOPMENT)
-        self.count_tokens()
+        if PAR.PROCESSES > 1:
+            self.count_tokens_parallel()
+        else:
+            self.corpus = epd_corpus.read(epd_corpus.DataSet.DEVELOPMENT)
+            self.count_tokens()
         self.lemmatize_tokens()
         self.apply_whitelist()
         self.filter_lemmas()
@@ -43,13 +82,30 @@ class Lemmatizer:
     def count_tokens(self):
         self.token_freq = Counter()
         for praktijk in self.corpus.praktijken:
-            for patient in praktijk.patienten:
-                for contact in patient.contacten:
-                    for deelcontact in contact.deelcontacten:
-                        for brief in deelcontact.brieven:
-                            self.process_document(brief)
-                        for notitie in deelcontact.notities:
-                            self.process_document(notitie)
+            self.count_praktijk(praktijk)
+
+    # Map-reduce version of count_tokens: every worker process reads and counts
+    # one praktijk at a time, and the per-praktijk counts are merged in
+    # praktijk order, so the result is identical to that of count_tokens.
+    def count_tokens_parallel(self):
+        LOG.enter('counting tokens in {} processes'.format(PAR.PROCESSES))
+        LOG.message('from {}'.format(CFG.CORPUS_PER_PRAKTIJK_DIR))
+        self.token_freq = Counter()
+        with multiprocessing.Pool(PAR.PROCESSES) as pool:
+            for ident, token_freq in pool.imap(count_praktijk_tokens, CFG.PRAKTIJK_IDS):
+                LOG.message('praktijk {}: {} unique tokens'.format(ident, len(token_freq)))
+                self.token_freq.update(token_freq)
+        LOG.message('{} unique tokens'.format(len(self.token_freq)))
+        LOG.leave()
+
+    def count_praktijk(self, praktijk):
+        for patient in praktijk.patienten:
+            for contact in patient.contacten:
+                for deelcontact in contact.deelcontacten:
+                    for brief in deelcontact.brieven:
+                        self.process_document(brief)
+                    for notitie in deelcontact.notities:
+                        self.process_document(notitie)
 
     def process_document(self, document):
         # Canonicalisatie: alles downcasen
@@ -81,51 +137,94 @@ class Lemmatizer:
         filename = CFG.DATA_DIR / 'spelling.csv'
         with CSV.FileReader(filename) as source:
             assert next(source) == ['PATTERN', 'REPLACEMENT']
-            self.spelling = [(re.compile(pattern), replacement) for pattern, replacement in source]
+            spelling = [(pattern, replacement) for pattern, replacement in source]
+        self.spelling = [(re.compile(pattern), replacement) for pattern, replacement in spelling]
+        self.spelling_guard = self.compile_guard(pattern for pattern, replacement in spelling)
         # Prefixes
         filename = CFG.DATA_DIR / 'prefix.csv'
         with CSV.FileReader(filename) as source:
             assert next(source) == ['PREFIX', 'REPLACEMENT']
             self.prefixes = [(prefix, replacement) for prefix, replacement in source]
-        # Postfixes
+        self.prefix_trie = AffixTrie(enumerate(prefix for prefix, replacement in self.prefixes))
+        # Postfixes: plain strings go into a trie of reversed postfixes, regexes are tried in turn
         filename = CFG.DATA_DIR / 'postfix.csv'
         with CSV.FileReader(filename) as source:
             assert next(source) == ['POSTFIX', 'REPLACEMENT']
-            self.postfixes = [(re.compile(postfix + r'\Z'), replacement) for postfix, replacement in source]
+            postfixes = [(postfix, replacement) for postfix, replacement in source]
+        self.postfixes = [(re.compile(postfix + r'\Z'), replacement) for postfix, replacement in postfixes]
+        self.postfix_trie = AffixTrie(((index, postfix) for index, (postfix, replacement) in enumerate(postfixes) if not REGEX_CHARS.search(postfix)), reverse=True)
+        self.regex_postfixes = [index for index, (postfix, replacement) in enumerate(postfixes) if REGEX_CHARS.search(postfix)]
+        LOG.message('{} spelling patterns, {} prefixes, {} postfixes ({} regexes)'.format(len(self.spelling), len(self.prefixes), len(self.postfixes), len(self.regex_postfixes)))
         # Lemmatiseren
+        self.sublemmatize = lru_cache(maxsize=LEMMA_CACHE_SIZE)(self.sublemmatize)
         self.token_lemmas = {}
         for token in self.token_freq:
             lemmas = self.lemmatize(token)
             self.token_lemmas[token] = lemmas
+        LOG.message('{} sublemma cache hits'.format(self.sublemmatize.cache_info().hits))
         LOG.leave()
 
-    # Converts a token into a list of zero or more lemmas.
+    # Merges the spelling patterns into one alternation. If that doesn't match
+    # a token, none of the patterns does, and all substitutions can be skipped.
+    # Patterns that refer to groups (backreferences and conditional groups)
+    # cannot be merged, because the group numbers shift, so then there is no
+    # guard.
+    @staticmethod
+    def compile_guard(patterns):
+        patterns = list(patterns)
+        if any(re.search(r'\\\d|\(\?P=|\(\?\(', pattern) for pattern in patterns):
+            return None
+        try:
+            return re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns))
+        except re.error:
+            return None
+
+    # Converts a token into a list of zero or more lemmas. Every token is
+    # lemmatized only once, so only its sublemmas go through the cache.
     def lemmatize(self, token):
+        return list(self.lemmatize_token(token))
+
+    # Converts a sublemma into a tuple of zero or more lemmas. Sublemmas recur
+    # across many tokens, so lemmatize_tokens replaces this method with a
+    # cached version.
+    def sublemmatize(self, token):
+        return self.lemmatize_token(token)
+
+    # Converts a token into a tuple of zero or more lemmas.
+    def lemmatize_token(self, token):
         # Initialisms (example: 'e.c.g.' => 'ecg')
         if INITIALISM.fullmatch(token):
             lemma = ''.join(c for c in token if c.isalpha())
-            return [lemma]
+            return (lemma,)
         # Gently correct a few common spelling errors
         lemma = token
-        for pattern, replacement in self.spelling:
-            lemma = pattern.sub(replacement, lemma)
+        if self.spelling_guard is None or self.spelling_guard.search(lemma):
+            for pattern, replacement in self.spelling:
+                lemma = pattern.sub(replacement, lemma)
         # Tweak affixes just because we can!
-        for prefix, replacement in self.prefixes:
-            if lemma.startswith(prefix):
-                lemma = replacement + lemma[len(prefix):]
-                break
-        for postfix, replacement in self.postfixes:
+        index = self.prefix_trie.first_match(lemma)
+        if index is not None:
+            prefix, replacement = self.prefixes[index]
+            lemma = replacement + lemma[len(prefix):]
+        first = self.postfix_trie.first_match(lemma)  # First plain postfix that matches
+        for index in self.regex_postfixes:
+            if first is not None and index > first: break
+            postfix, replacement = self.postfixes[index]
             lemma, count = postfix.subn(replacement, lemma)
-            if count: break
+            if count:
+                first = None
+                break
+        if first is not None:
+            postfix, replacement = self.postfixes[first]
+            lemma = postfix.sub(replacement, lemma)
         # Split the lemma into sublemmas at full stops and dashes
         if SEPARATOR.search(lemma):
             lemmas = SEPARATOR.split(lemma)  # Split at . and -
             lemmas = [lemma for lemma in lemmas if lemma]  # Remove empty sublemmas
-            lemmas = [self.lemmatize(lemma) for lemma in lemmas]
-            lemmas = sum(lemmas, [])  # Flatten the list of lists
-            return lemmas
+            lemmas = [self.sublemmatize(lemma) for lemma in lemmas]
+            return tuple(chain.from_iterable(lemmas))  # Flatten the tuple of tuples
         # Klaar!
-        return [lemma]
+        return (lemma,)
 
     def apply_whitelist(self):
         LOG.enter('apply whitelist')
@@ -184,6 +283,14 @@ class Lemmatizer:
         LOG.leave()
 
 
+# Worker for Lemmatizer.count_tokens_parallel.
+def count_praktijk_tokens(ident):
+    lemmatizer = Lemmatizer()
+    lemmatizer.token_freq = Counter()
+    lemmatizer.count_praktijk(epd_corpus.read_praktijk(ident, epd_corpus.DataSet.DEVELOPMENT))
+    return ident, lemmatizer.token_freq
+
+
 if __name__ == '__main__':
     LOG.enter(__file__)
     PAR.read(CFG.SOURCE_DIR)
@@ -8,16 +8,106 @@ from word2vec_rank import Word2vecRanker
 from entropy_rank import EntropyRanker
 from get_arff import ArffGenerator
 
+import keyword_table
+import multiprocessing
+import queue
+import time
+import traceback
+
+
+# The Phase 2 tasks as (name, function, names of the tasks it depends on).
+# The keyword table is built first, so that the rankers read its cache
+# instead of each parsing dev_kwd.csv.
+TASKS = [
+    ('keyword table', keyword_table.read, ()),
+    ('frequency ranking', FrequencyRanker().run, ('keyword table',)),
+    ('word2vec training set', Word2vecTrainer().run, ('keyword table',)),
+    ('word2vec ranking', Word2vecRanker().run, ('word2vec training set',)),
+    ('entropy ranking', EntropyRanker().run, ('keyword table',)),
+    ('event ARFF files', ArffGenerator().run, ()),
+]
+
+# The parameters that size the pools of the tasks
+CORE_BUDGETS = ('PROCESSES', 'WORD2VEC_THREADS')
+
 
 class Phase2Maker:
 
     def run(self):
         PAR.read(CFG.SOURCE_DIR)
-        FrequencyRanker().run()
-        Word2vecTrainer().run()
-        Word2vecRanker().run()
-        EntropyRanker().run()
-        ArffGenerator().run()
+        self.timings = {}  # task name => seconds
+        if PAR.PROCESSES > 1:
+            self.run_parallel()
+        else:
+            self.run_serial()
+        LOG.enter('Phase 2 timings')
+        for name, function, dependencies in TASKS:
+            LOG.message('{}: {:.3f} sec'.format(name, self.timings[name]))
+        LOG.leave()
+
+    def run_serial(self):
+        for name, function, dependencies in TASKS:
+            time_begin = time.time()
+            function()
+            self.timings[name] = time.time() - time_begin
+
+    # Runs every task in its own process as soon as the tasks it depends on
+    # are done, with at most PAR.PROCESSES tasks at a time. Tasks that start
+    # together split the processes and word2vec threads between them, so that
+    # their pools do not oversubscribe the cores. If a task fails, the tasks
+    # still running are terminated and the error is raised here.
+    def run_parallel(self):
+        context = multiprocessing.get_context('fork')  # Workers inherit the parameters
+        results = context.Queue()
+        waiting = list(TASKS)
+        running = {}  # task name => process
+        done = set()
+        while waiting or running:
+            ready = [task for task in waiting if all(dependency in done for dependency in task[2])]
+            ready = ready[:PAR.PROCESSES - len(running)]
+            budget = {key: max(1, getattr(PAR, key) // max(1, len(running) + len(ready))) for key in CORE_BUDGETS if hasattr(PAR, key)}
+            for task in ready:
+                name, function, dependencies = task
+                process = context.Process(target=_run_task, args=(name, function, budget, results), name=name)
+                process.start()
+                running[name] = process
+                waiting.remove(task)
+            if not running:
+                raise RuntimeError('Phase 2 tasks with unknown dependencies: {}'.format(', '.join(name for name, function, dependencies in waiting)))
+            name, seconds, error = self.next_result(results, running)
+            running.pop(name).join()
+            if error:
+                for process in running.values():
+                    process.terminate()
+                    process.join()
+                raise RuntimeError('Phase 2 task "{}" failed:\n{}'.format(name, error))
+            self.timings[name] = seconds
+            done.add(name)
+
+    # Waits for a task to finish, also noticing workers that die without
+    # reporting back, such as after a crash in a C extension.
+    def next_result(self, results, running):
+        while True:
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                for name, process in running.items():
+                    if process.exitcode:
+                        return name, 0.0, 'process exited with code {}'.format(process.exitcode)
+
+
+# Runs a task in a worker process with its share of the cores (parameter
+# name => value), and reports (name, seconds, error) back.
+def _run_task(name, function, budget, results):
+    for key, value in budget.items():
+        setattr(PAR, key, value)
+    time_begin = time.time()
+    try:
+        function()
+        results.put((name, time.time() - time_begin, None))
+    except BaseException:
+        results.put((name, time.time() - time_begin, traceback.format_exc()))
+
 
 if __name__ == '__main__':
     LOG.enter(__file__)
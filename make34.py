@@ -4,7 +4,7 @@ from support import parameters as PAR
 
 from filter_kwd import KeywordFilter
 from filter_evt import EventFilter
-from get_histories import HistoryGenerator
+from history_store import HistoryStore
 from xsplit import Splitter
 from model import TensorFlower
 from report import Reporter
@@ -79,7 +79,7 @@ class Phase3Maker:
         PAR.read(directory)
         KeywordFilter().run(directory)
         EventFilter().run(directory)
-        HistoryGenerator().run(directory)
+        HistoryStore().run(directory, self.rebuild)  # Builds the histories, or reuses those of an experiment with the same inputs
         if PAR.WORKFLOW == 'DEVELOPMENT':
             Splitter().run(directory)
         TensorFlower().run(directory)
@@ -2,7 +2,10 @@ from support import config as CFG
 from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
+from support import history_file as HF
 
+import hashlib
+import itertools
 import math
 import os
 import random
@@ -11,10 +14,17 @@ from datetime import date
 from pathlib import Path
 import tensorflow as tf
 import numpy as np
+import scipy.sparse
 from datetime import datetime
 
-class Patient:
-    pass
+CSV_CHUNK = 1000  # Patients parsed at a time
+
+
+# Returns the bucket and sign of a feature for feature hashing. The hash must
+# not change between runs, so Python's hash() cannot be used.
+def hash_feature(feature, buckets):
+    digest = hashlib.md5(feature.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little') % buckets, 1.0 if digest[8] & 1 else -1.0
 
 
 class TensorFlower():
@@ -56,57 +66,97 @@ class Trainer():
             self.features = self.collect_features(self.train_patienten)
             self.train_lstm()
 
+    # Reads the histories from the binary history file next to the CSV file
+    # (see support/history_file.py), unless the CSV file is newer. In that case
+    # the CSV file is parsed, and the binary file is written as a cache for the
+    # next time.
     def read_patienten(self, filename):
-        patienten = []
+        binary = Path(filename).with_suffix('.npz')
+        if binary.is_file() and os.path.getmtime(str(binary)) >= os.path.getmtime(filename):
+            patienten = HF.read(binary)
+        else:
+            patienten = self.read_csv_patienten(filename)
+            HF.write(binary, patienten)
+        self.num_bins = patienten.num_periods
+        return patienten
+
+    # Parses a history CSV file in chunks of CSV_CHUNK patients. The items of all
+    # periods in a chunk are split in one go, and their values converted to
+    # floats with a single NumPy call.
+    def read_csv_patienten(self, filename):
+        patients = []
+        features = {}  # feature => column, in order of appearance
+        lengths, indices, values = [], [], []  # per chunk
         with CSV.FileReader(filename) as source:
             headers = next(source)
             assert headers[:2] == ['PRAKTIJK-ID', 'PATIENT-ID']
             del headers[:2]
             for maand, header in enumerate(headers):
                 assert header == 'P{0}'.format(maand)
-            self.num_bins = len(headers)
-            for row in source:
-                patient = Patient()
-                patient.praktijk = row[0]
-                patient.id = row[1]
-                patient.historie = []
-                for period_num, data in enumerate(row[2:]):  # data is something like 'r:abc=1,i:f39=2'
-                    period = []
-                    if data:
-                        items = data.split(',')
-                        for item in items:
-                            feature, frequentie = item.split('=')
-                            period.append((feature, float(frequentie)))
-                    patient.historie.append(period)
-                patienten.append(patient)
-        return patienten
+            while True:
+                rows = list(itertools.islice(source, CSV_CHUNK))
+                if not rows: break
+                patients.extend((row[0], row[1]) for row in rows)
+                cells = [cell for row in rows for cell in row[2:]]  # each cell is something like 'r:abc=1,i:f39=2'
+                lengths.append(np.array([cell.count(',') + 1 if cell else 0 for cell in cells], dtype='int64'))
+                items = ','.join(cell for cell in cells if cell)
+                tokens = items.replace('=', ',').split(',') if items else []  # feature, value, feature, value...
+                for feature in dict.fromkeys(tokens[0::2]):
+                    features.setdefault(feature, len(features))
+                indices.append(np.fromiter(map(features.__getitem__, tokens[0::2]), dtype='int32'))
+                values.append(np.array(tokens[1::2], dtype='float64'))
+        lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype='int64')
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype='int32')
+        values = np.concatenate(values) if values else np.zeros(0)
+        matrix = scipy.sparse.csr_matrix((values, indices, indptr), shape=(len(lengths), len(features)))
+        return HF.Histories(patients, list(features), matrix, len(headers))
 
+    # Returns feature => (input column, sign) for the features of the training
+    # data, and sets self.num_inputs to the number of input columns.
+    #   With PAR.FEATURE_BUCKETS, the keyword and event features ('name:tag')
+    # are hashed into that many columns, so the number of inputs no longer
+    # grows with the vocabulary. Each feature also gets a sign of +1 or -1 from
+    # its hash, so that features sharing a column tend to cancel out rather
+    # than add up. The other features (age, geslacht and word2vec dimensions)
+    # get a column of their own after the buckets.
     def collect_features(self, patienten):
-        features = set()
-        for patient in patienten:
-            for period in patient.historie:
-                for feature, frequentie in period:
-                    features.add(feature)
-        features = {feature: index for index, feature in enumerate(sorted(features))}
-        return features
+        features = sorted(patienten.used_features())
+        buckets = getattr(PAR, 'FEATURE_BUCKETS', 0)  # Param.txt files of older experiments lack FEATURE_BUCKETS
+        if not buckets:
+            self.num_inputs = len(features)
+            return {feature: (index, 1.0) for index, feature in enumerate(features)}
+        unhashed = [feature for feature in features if ':' not in feature]
+        self.num_inputs = buckets + len(unhashed)
+        columns = {feature: (buckets + index, 1.0) for index, feature in enumerate(unhashed)}
+        for feature in features:
+            if ':' in feature:
+                columns[feature] = hash_feature(feature, buckets)
+        LOG.message('{} features hashed into {} buckets'.format(len(features) - len(unhashed), buckets))
+        return columns
+
+    # The input column and sign of every feature in a set of histories. Features
+    # not in self.features get column -1.
+    def feature_indices(self, patienten):
+        columns, signs = zip(*[self.features.get(feature, (-1, 0.0)) for feature in patienten.features]) if patienten.features else ((), ())
+        return np.array(columns, dtype='int64'), np.array(signs, dtype='float64')
 
     # Returns a list of feature vectors, with one feature vector for each period
-    def generate_vectors(self, historie):
-        feature_vectors = []
-        for period in historie:
-            feature_vector = len(self.features) * [0]
-            for feature, frequentie in period:
-                if feature in self.features:
-                    index = self.features[feature]
-                    feature_vector[index] = frequentie
-            feature_vectors.append(np.array(feature_vector))
-        return feature_vectors
+    def generate_vectors(self, patienten, patient, indices):
+        columns, signs = indices
+        periods = patienten.periods(patient).tocoo()
+        known = columns[periods.col] >= 0
+        items = periods.col[known]
+        feature_vectors = np.zeros((patienten.num_periods, self.num_inputs))
+        np.add.at(feature_vectors, (periods.row[known], columns[items]), signs[items] * periods.data[known])  # Hashed features can share a column
+        return list(feature_vectors)
 
     def train_lstm(self):
         # Prepare training data
         train_data = []
-        for patient in self.train_patienten:
-            feature_vectors = self.generate_vectors(patient.historie)
+        indices = self.feature_indices(self.train_patienten)
+        for patient in range(len(self.train_patienten)):
+            feature_vectors = self.generate_vectors(self.train_patienten, patient, indices)
             win_begin, win_end = 0, PAR.WINDOW_SIZE
             while win_end <= PAR.HISTORY_LENGTH:
                 window_vectors = feature_vectors[win_begin:win_end]
@@ -123,8 +173,10 @@ class Trainer():
 
         # Prepare test data
         test_data = []
-        for patient in self.test_patienten:
-            feature_vectors = self.generate_vectors(patient.historie)
+        indices = self.feature_indices(self.test_patienten)
+        for patient in range(len(self.test_patienten)):
+            praktijk, patient_id = self.test_patienten.patients[patient]
+            feature_vectors = self.generate_vectors(self.test_patienten, patient, indices)
             win_begin, win_end = 0, PAR.WINDOW_SIZE
             while win_end <= PAR.HISTORY_LENGTH:
                 window_vectors = feature_vectors[win_begin:win_end]
@@ -132,16 +184,16 @@ class Trainer():
                     label = np.array([1 if period == win_begin else 0 for period in range(PAR.HISTORY_LENGTH - PAR.WINDOW_SIZE + 1)])  #one hot
                     if PAR.LAST_PERIOD == False:
                         if label[0] == 0:
-                            test_data.append((patient.praktijk, patient.id, win_begin, window_vectors, label))  # win_begin is de ouderdom: periods to live
+                            test_data.append((praktijk, patient_id, win_begin, window_vectors, label))  # win_begin is de ouderdom: periods to live
                     else:
-                        test_data.append((patient.praktijk, patient.id, win_begin, window_vectors, label))  # win_begin is de ouderdom: periods to live
+                        test_data.append((praktijk, patient_id, win_begin, window_vectors, label))  # win_begin is de ouderdom: periods to live
                 win_begin += 1
                 win_end += 1
         random.shuffle(test_data)
 
         # Build TensorFlow graph
         tf.reset_default_graph()
-        data = tf.placeholder(tf.float32, [None, PAR.WINDOW_SIZE, len(self.features)])
+        data = tf.placeholder(tf.float32, [None, PAR.WINDOW_SIZE, self.num_inputs])
         target = tf.placeholder(tf.float32, [None, PAR.HISTORY_LENGTH - PAR.WINDOW_SIZE + 1])
         layers = [] # network layers: each layer is a block of dropout cells
         for layer_num in range(PAR.NUM_LAYERS):
@@ -5,68 +5,46 @@ from support import parameters as PAR
 
 import re
 
+# Keep only lemmas that:
+#   *  consist entirely of letters and dashes;
+#   *  have at least one letter on both sides of every dash;
+#   *  contain at least two letters.
+LEMMA = re.compile('[a-z]+(-[a-z]+)*')
+
+
 class FrogPostprocessor:
 
     def run(self):
         LOG.enter(self.__class__.__name__ + '.run()')
         LOG.enter('development set')
-        self.read_frog_output('dev')
-        self.downcase()
-        self.filter()
-        self.write_lemmas('dev')
+        self.process('dev')
         LOG.leave()
         LOG.enter('validation set')
-        self.read_frog_output('val')
-        self.downcase()
-        self.filter()
-        self.write_lemmas('val')
+        self.process('val')
         LOG.leave()
         LOG.leave()
 
-    def read_frog_output(self, data_set):
-        LOG.enter('reading Frog output')
-        filename = CFG.PHASE1_DIR / 'Temp' / '{}_lemmas.csv'.format(data_set)
-        LOG.message('from {}'.format(filename))
-        with CSV.FileReader(filename) as source:
+    # Reads the Frog output, downcases and filters the lemmas, and writes
+    # the keywords in a single pass, one row at a time.
+    def process(self, data_set):
+        LOG.enter('Postprocessing Frog output')
+        source_name = CFG.PHASE1_DIR / 'Temp' / '{}_lemmas.csv'.format(data_set)
+        target_name = CFG.PHASE1_DIR / 'Keywords' / '{}_kwd.csv'.format(data_set)
+        LOG.message('from {}'.format(source_name))
+        LOG.message('to {}'.format(target_name))
+        read_count, write_count = 0, 0
+        with CSV.FileReader(source_name) as source, CSV.FileWriter(target_name) as target:
             assert next(source) == ['PROGRESS', 'PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG']
-            self.lemmas = [row for row in source]
-        LOG.message('{} (lemma, postag) pairs'.format(len(self.lemmas)))
-        LOG.leave()
-
-    def downcase(self):
-        LOG.message('Downcasing lemmas')
-        lemmas = []
-        for progress, praktijk_id, patient_id, levensverwachting, lemma, postag in self.lemmas:
-            lemma = lemma.casefold()
-            lemmas.append((praktijk_id, patient_id, levensverwachting, lemma, postag))
-        self.lemmas = lemmas
-
-    # Keep only lemmas that:
-    #   *  consist entirely of letters and dashes;
-    #   *  have at least one letter on both sides of every dash;
-    #   *  contain at least two letters.
-    def filter(self):
-        LOG.enter('Filtering lemmas')
-        regex = re.compile('[a-z]+(-[a-z]+)*')
-        lemmas = []
-        for row in self.lemmas:
-            lemma = row[3]
-            if len(lemma) > 1 and regex.fullmatch(lemma):
-                lemmas.append(row)
-        reject_count = len(self.lemmas) - len(lemmas)
-        LOG.message('{} lemmas rejected'.format(reject_count))
-        self.lemmas = lemmas
-        LOG.leave()
-
-    def write_lemmas(self, data_set):
-        LOG.enter('Writing lemmas')
-        filename = CFG.PHASE1_DIR / 'Keywords' / '{}_kwd.csv'.format(data_set)
-        LOG.message('to {}'.format(filename))
-        with CSV.FileWriter(filename) as target:
             target.writerow(['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'LEMMA', 'POSTAG'])
-            for row in self.lemmas:
-                target.writerow(row)
-        LOG.message('{} lemmas'.format(len(self.lemmas)))
+            for progress, praktijk_id, patient_id, levensverwachting, lemma, postag in source:
+                read_count += 1
+                lemma = lemma.casefold()
+                if len(lemma) > 1 and LEMMA.fullmatch(lemma):
+                    target.writerow((praktijk_id, patient_id, levensverwachting, lemma, postag))
+                    write_count += 1
+        LOG.message('{} (lemma, postag) pairs'.format(read_count))
+        LOG.message('{} lemmas rejected'.format(read_count - write_count))
+        LOG.message('{} lemmas'.format(write_count))
         LOG.leave()
 
 if __name__ == '__main__':
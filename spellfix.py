@@ -2,9 +2,15 @@ from support import config as CFG
 from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
+from support import lexicon as LEX
+from support import vocabulary as VOC
 
+from array import array
 from collections import Counter, defaultdict
+from itertools import chain
+from trie import FrequencyTrie
 import editdistance
+import numpy
 import re
 
 # Filter for acceptable spelling correction targets.
@@ -20,6 +26,7 @@ class SpellingFixer:
         self.read_tokens('dev')
         self.find_contexts()
         self.find_token_freq()
+        self.build_split_tries()
         self.read_opentaal()
         self.correct_spelling()
         self.reconstruct_texts()
@@ -29,6 +36,7 @@ class SpellingFixer:
         self.read_tokens('val')
         self.find_contexts()
         self.find_token_freq()
+        self.build_split_tries()
         self.read_opentaal()
         self.correct_spelling()
         self.reconstruct_texts()
@@ -84,101 +92,142 @@ class SpellingFixer:
         LOG.leave()
 
     # Read the tokens to spellfix.
-    # Memoized spelling corrections are applied immediately.
+    # The token stream is stored as three integer columns: vocabulary id,
+    # postag id and document id. A document is a run of consecutive tokens
+    # with the same (praktijk id, patient id, levensverwachting).
     def read_tokens(self, data_set):
         LOG.enter('reading tokens')
         filename = CFG.PHASE1_DIR / 'Temp' / '{}_tokens.csv'.format(data_set)
         LOG.message('from {}'.format(filename))
-        self.tokens = []
+        self.vocabulary = VOC.Vocabulary()
+        self.postags = VOC.Vocabulary()
+        self.documents = []  # doc id => (praktijk_id, patient_id, levensverwachting)
+        token_ids, postag_ids, doc_ids = array('i'), array('i'), array('i')
         with CSV.FileReader(filename) as source:
             assert next(source) == ['PRAKTIJK-ID', 'PATIENT-ID', 'LEVENSVERWACHTING', 'TOKEN', 'POSTAG']
+            current_key = None
             for praktijk_id, patient_id, levensverwachting, token, postag in source:
-                self.tokens.append((praktijk_id, patient_id, levensverwachting, token, postag))
-        # del self.tokens[100000:]
-        LOG.message('{} tokens'.format(len(self.tokens)))
+                key = (praktijk_id, patient_id, levensverwachting)
+                if key != current_key:
+                    current_key = key
+                    self.documents.append(key)
+                token_ids.append(self.vocabulary.encode(token))
+                postag_ids.append(self.postags.encode(postag))
+                doc_ids.append(len(self.documents) - 1)
+        self.token_ids = numpy.array(token_ids, dtype='int32')
+        self.postag_ids = numpy.array(postag_ids, dtype='int32')
+        self.doc_ids = numpy.array(doc_ids, dtype='int32')
+        LOG.message('{} tokens'.format(len(self.token_ids)))
+        LOG.message('{} unique tokens, {} postags, {} documents'.format(len(self.vocabulary), len(self.postags), len(self.documents)))
         LOG.leave()
 
     # Find the set of words that can appear in any given context.
     # Tokens containing punctuation or digits are rejected.
     def find_contexts(self):
         LOG.enter('finding tokens in context')
+        true_word = numpy.array([bool(TRUE_WORD.fullmatch(word)) for word in self.vocabulary.words], dtype=bool)
+        count = len(self.token_ids)
+        tokens = self.token_ids[1:count - 1]
+        mask = true_word[tokens]  # No punctuation, digits etc.
+        left_postags = self.postag_ids[:count - 2][mask]
+        right_postags = self.postag_ids[2:][mask]
+        tokens_in_context = numpy.unique(numpy.stack([left_postags, right_postags, tokens[mask]], axis=1), axis=0)
         self.contexts = defaultdict(set)
-        for index in range(1, len(self.tokens) - 1):
-            token = self.tokens[index][3]
-            if TRUE_WORD.fullmatch(token):  # No punctuation, digits etc.
-                left_postag = self.tokens[index - 1][4]
-                right_postag = self.tokens[index + 1][4]
-                context = (left_postag, right_postag)
-                self.contexts[context].add(token)
+        for left_postag, right_postag, token in tokens_in_context:
+            context = (self.postags.words[left_postag], self.postags.words[right_postag])
+            self.contexts[context].add(self.vocabulary.words[token])
         LOG.message('{} contexts'.format(len(self.contexts)))
-        LOG.message('{} unique tokens-in-context'.format(sum(len(tokens) for tokens in self.contexts.values())))
+        LOG.message('{} unique tokens-in-context'.format(len(tokens_in_context)))
         LOG.leave()
         
     # Find the frequency of all tokens over the entire corpus.
     def find_token_freq(self):
         LOG.enter('counting token frequencies')
-        self.token_freq = Counter()
-        for praktijk_id, patient_id, levensverwachting, token, postag in self.tokens:
-            self.token_freq[token] += 1
+        counts = numpy.bincount(self.token_ids, minlength=len(self.vocabulary))
+        self.token_freq = Counter({word: int(count) for word, count in zip(self.vocabulary.words, counts) if count})
         LOG.message('{} unique tokens'.format(len(self.token_freq)))
         LOG.leave()
 
-    # Read the OpenTaal word frequencies,
-    # but convert the words to lower case.
+    # Index the corpus vocabulary front to back and back to front, so that all
+    # candidate splits of a token can be found in a single walk in either direction.
+    def build_split_tries(self):
+        LOG.enter('building split tries')
+        self.prefix_trie = FrequencyTrie(self.token_freq)
+        self.suffix_trie = FrequencyTrie(self.token_freq, reverse=True)
+        LOG.leave()
+
+    # Look up the OpenTaal word frequencies of the corpus tokens in the
+    # compiled, lower-cased lexicon written by wordfreq.py.
     def read_opentaal(self):
         LOG.enter('reading OpenTaal word frequencies')
-        filename = CFG.DATA_DIR / 'word_frequencies.csv'
-        LOG.message('from {}'.format(filename))
-        # Read the frequency list, converting words to lower case
-        self.opentaal_freq = Counter()
-        with CSV.FileReader(filename) as source:
-            for word, freq in source:
-                word = word.lower()
-                freq = int(freq)
-                self.opentaal_freq[word] += freq
-        self.opentaal_freq = {word: freq for word, freq in self.opentaal_freq.items() if freq >= PAR.MIN_OPENTAAL_FREQ}
-        LOG.message('{} words'.format(len(self.opentaal_freq)))
+        basename = CFG.PHASE1_DIR / 'Temp' / 'wordfreq'
+        LOG.message('from {}_*.npy'.format(basename))
+        if not LEX.exists(basename):
+            raise RuntimeError('No compiled OpenTaal lexicon {}_*.npy: run wordfreq.py first'.format(basename))
+        lexicon = LEX.Lexicon(basename)
+        tokens = list(self.token_freq)
+        freqs = lexicon.lookup(tokens)
+        self.opentaal_freq = {token: int(freq) for token, freq in zip(tokens, freqs) if freq >= PAR.MIN_OPENTAAL_FREQ}
+        LOG.message('{} words in lexicon'.format(len(lexicon)))
+        LOG.message('{} corpus tokens found'.format(len(self.opentaal_freq)))
         LOG.leave()
 
     # Run each token in turn through the decision tree.
+    # The decision depends only on the token and its context, so it is made
+    # once for every unique (left postag, token, right postag) triple and then
+    # applied to the whole token stream at once. A token may be replaced by
+    # more than one token; the stream is expanded accordingly.
     # TODO: Since different contexts have different numbers of tokens that appear
     # in that context, we should require a different minimum frequency for each
     # context. But how, exactly?
     def correct_spelling(self):
         LOG.enter('Correcting spelling')
-        LOG.message('{} tokens to check'.format(len(self.tokens)))
-        tokens = []
-        for index, (praktijk_id, patient_id, levensverwachting, token, postag) in enumerate(self.tokens):
+        LOG.message('{} tokens to check'.format(len(self.token_ids)))
+        left_postags = numpy.roll(self.postag_ids, 1)
+        right_postags = numpy.roll(self.postag_ids, -1)
+        triples = numpy.stack([left_postags, self.token_ids, right_postags], axis=1)
+        triples, inverse = numpy.unique(triples, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        LOG.message('{} unique tokens-in-context to check'.format(len(triples)))
+        replacements = []  # triple => list of vocabulary ids
+        for index, (lpostag, token, rpostag) in enumerate(triples):
             if index % 1000 == 0: print(index, end='\r')
-            lpostag = self.tokens[index - 1][4]
-            rpostag = self.tokens[(index + 1) % len(self.tokens)][4]
-            context = (lpostag, rpostag)
-            if context in self.spellfix and token in self.spellfix[context]:
-                # If a known spelling correction exists, apply that.
-                replacement = self.spellfix[context][token]
-                tokens.append((praktijk_id, patient_id, levensverwachting, replacement, postag))
-            elif token in self.opentaal_freq:
-                # If a token has a high OpenTaal frequency, we assume it's spelled correctly.
-                tokens.append((praktijk_id, patient_id, levensverwachting, token, postag))
-            elif self.token_freq[token] >= PAR.MIN_EPD_FREQ:
-                # If a token has a high corpus frequency, we assume it's spelled correctly
-                tokens.append((praktijk_id, patient_id, levensverwachting, token, postag))
-            else:
-                # Otherwise, we suspect a spelling mistake.
-                replacement = self.find_replacement(context, token)
-                if replacement:
-                    token = replacement
-                    tokens.append((praktijk_id, patient_id, levensverwachting, token, postag))
-                else:
-                    replacement = self.onterechte_samenstelling(context, token)
-                    if replacement:
-                        for token in replacement:
-                            tokens.append((praktijk_id, patient_id, levensverwachting, token, postag))
-                    else:
-                        tokens.append((praktijk_id, patient_id, levensverwachting, token, postag))
-        self.tokens = tokens
+            context = (self.postags.words[lpostag], self.postags.words[rpostag])
+            replacement = self.correct_token(context, self.vocabulary.words[token])
+            replacements.append([self.vocabulary.encode(word) for word in replacement.split(' ')])
+        # Expand the token stream: position p becomes lengths[inverse[p]] tokens
+        lengths = numpy.array([len(replacement) for replacement in replacements], dtype='int64')
+        offsets = numpy.cumsum(lengths) - lengths
+        flat = numpy.fromiter(chain.from_iterable(replacements), dtype='int32', count=int(lengths.sum()))
+        counts = lengths[inverse]
+        firsts = numpy.cumsum(counts) - counts  # First output position of every input position
+        positions = numpy.repeat(offsets[inverse] - firsts, counts) + numpy.arange(int(counts.sum()))
+        self.token_ids = flat[positions]
+        self.postag_ids = numpy.repeat(self.postag_ids, counts)
+        self.doc_ids = numpy.repeat(self.doc_ids, counts)
         LOG.leave()
 
+    # Returns the correct spelling of a token in context. Split compounds
+    # are returned as two words separated by a space.
+    def correct_token(self, context, token):
+        if context in self.spellfix and token in self.spellfix[context]:
+            # If a known spelling correction exists, apply that.
+            return self.spellfix[context][token]
+        elif token in self.opentaal_freq:
+            # If a token has a high OpenTaal frequency, we assume it's spelled correctly.
+            return token
+        elif self.token_freq[token] >= PAR.MIN_EPD_FREQ:
+            # If a token has a high corpus frequency, we assume it's spelled correctly
+            return token
+        # Otherwise, we suspect a spelling mistake.
+        replacement = self.find_replacement(context, token)
+        if replacement:
+            return replacement
+        replacement = self.onterechte_samenstelling(context, token)
+        if replacement:
+            return ' '.join(replacement)
+        return token
+
     def find_replacement(self, context, token):
         candidates = []
         min_dist = PAR.MAX_REL_EDIT_DIST
@@ -222,15 +271,23 @@ class SpellingFixer:
         if not WORD_LIKE.search(token): return
         
         # Find the most plausible split. Plausibility is defined as the corpus frequency
-        # of the least frequent of the left and right parts.
+        # of the least frequent of the left and right parts. Dashes around either part
+        # are ignored, so the parts are looked up in token[begin:end].
+        begin = len(token) - len(token.lstrip('-'))
+        end = len(token.rstrip('-'))
+        left_freq = self.prefix_trie.walk(token, begin, end)   # left_freq[i]: frequency of token[begin:i]
+        right_freq = self.suffix_trie.walk(token, begin, end)  # right_freq[i]: frequency of token[i:end]
+        for i in range(begin + 1, end + 1):
+            if token[i - 1] == '-':
+                left_freq[i] = left_freq[i - 1]  # Left part ends in a dash
         best_plausibility = 0
         best_split = None
         for i in range(2, len(token) - 1):
             if token[i] == '-': continue
-            left, right = token[:i].strip('-'), token[i:].strip('-')
-            if left not in self.token_freq or right not in self.token_freq: continue
-            plausibility = min(self.token_freq[left], self.token_freq[right])
+            if not left_freq[i] or not right_freq[i]: continue
+            plausibility = min(left_freq[i], right_freq[i])
             if plausibility < PAR.MIN_EPD_FREQ: continue  # Implausible
+            left, right = token[begin:i].rstrip('-'), token[i:end]
             if plausibility == best_plausibility:
                 print('SPLIT COLLISION: {} => {} or {} with p = {}'.format(token, best_split, (left, right), plausibility))
                 pass
@@ -243,19 +300,14 @@ class SpellingFixer:
 
     def reconstruct_texts(self):
         self.texts = []
-        current_key = None
-        current_tokens = []
-        for praktijk_id, patient_id, levensverwachting, token, postag in self.tokens:
-            key = (praktijk_id, patient_id, levensverwachting)
-            if key != current_key:
-                if current_key:
-                    text = ' '.join(current_tokens)
-                    self.texts.append(current_key + (text,))
-                current_key = key
-                current_tokens = []
-            current_tokens.append(token)
-        text = ' '.join(current_tokens)
-        self.texts.append(current_key + (text,))
+        words = numpy.array(self.vocabulary.words, dtype=object)[self.token_ids]
+        bounds = numpy.flatnonzero(numpy.diff(self.doc_ids)) + 1
+        begins = numpy.concatenate([[0], bounds])
+        ends = numpy.concatenate([bounds, [len(words)]])
+        for begin, end in zip(begins, ends):
+            if begin < end:
+                text = ' '.join(words[begin:end])
+                self.texts.append(self.documents[self.doc_ids[begin]] + (text,))
 
     def write_output(self, data_set):
         LOG.enter('writing texts')
@@ -0,0 +1,43 @@
+# Writes the @data section of an ARFF file in sparse format.
+#   An instance is one moment in a patient's history: all events of the patient
+# with the same days to live. Its attributes are the number of events per
+# attribute column, and the days to live as the last attribute:
+#     {3 2, 17 1, 120 365}
+# Attributes that are zero are left out, which keeps the file small even with
+# thousands of attributes. See waikato.github.io/weka-wiki/formats_and_processing/arff_stable/
+#   The events are given as parallel integer arrays (patient, days to live,
+# attribute column), with column -1 for events that are not an attribute.
+# Instances are built and written one patient at a time.
+
+import numpy
+
+
+def write_sparse_data(target, patients, days, columns, num_attributes):
+    target.write('\n@data\n')
+    keep = columns >= 0
+    patients, days, columns = patients[keep], days[keep], columns[keep]
+    order = numpy.lexsort((columns, -days, patients))  # By patient, then chronologically
+    bounds = numpy.flatnonzero(numpy.diff(patients[order])) + 1
+    count = 0
+    for indices in numpy.split(order, bounds):
+        count += _write_patient(target, days[indices], columns[indices], num_attributes)
+    return count
+
+
+# Writes the instances of one patient, given its events sorted by days to live
+# and column. Returns the number of instances written.
+def _write_patient(target, days, columns, num_attributes):
+    if len(days) == 0: return 0
+    starts = numpy.flatnonzero(numpy.concatenate([[True], (days[1:] != days[:-1]) | (columns[1:] != columns[:-1])]))
+    counts = numpy.diff(numpy.append(starts, len(days)))
+    days, columns = days[starts].tolist(), columns[starts].tolist()
+    count = 0
+    values = []
+    for index, (day, column, value) in enumerate(zip(days, columns, counts.tolist())):
+        values.append('{} {}'.format(column, value))
+        if index + 1 == len(days) or days[index + 1] != day:
+            values.append('{} {}'.format(num_attributes, day))  # DaysToLive
+            target.write('{' + ', '.join(values) + '}\n')
+            values = []
+            count += 1
+    return count
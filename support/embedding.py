@@ -0,0 +1,54 @@
+# A compiled word embedding that can be opened without parsing.
+#   The embedding is stored as an array of keys and a float32 matrix with one
+# row per key, each in its own .npy file. Both are opened as memory maps, so
+# opening is instantaneous and processes that open the same files share the
+# pages of the matrix through the operating system's page cache.
+#   Vectors are looked up in bulk: convert the keys to row numbers with
+# rows(), then fancy-index the matrix with them.
+
+import numpy
+import os
+
+
+def _filenames(basename):
+    basename = str(basename)
+    return basename + '_keys.npy', basename + '_vectors.npy'
+
+
+# Compiles keys and their vectors into basename_keys.npy and basename_vectors.npy.
+# The vectors are written last, under a temporary name, so a compiled embedding
+# is complete whenever basename_vectors.npy exists.
+def write(basename, keys, vectors):
+    keys_file, vectors_file = _filenames(basename)
+    keys = numpy.array(keys, dtype=str).reshape(-1)
+    vectors = numpy.array(vectors, dtype='float32').reshape(len(keys), -1)
+    for filename, data in ((keys_file, keys), (vectors_file, vectors)):
+        # numpy.save appends .npy to names that lack it, so write through a file object.
+        with open(filename + '.tmp', 'wb') as target:
+            numpy.save(target, data)
+        os.replace(filename + '.tmp', filename)
+
+
+def exists(basename):
+    keys_file, vectors_file = _filenames(basename)
+    return os.path.isfile(vectors_file)
+
+
+class Embedding:
+
+    def __init__(self, basename):
+        keys_file, vectors_file = _filenames(basename)
+        self.keys = numpy.load(keys_file).tolist()
+        self.vectors = numpy.load(vectors_file, mmap_mode='r')
+        self.index = {key: row for row, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def dimensions(self):
+        return self.vectors.shape[1]
+
+    # Returns an array with the row of every key, or -1 for unknown keys.
+    def rows(self, keys):
+        return numpy.array([self.index.get(key, -1) for key in keys], dtype='int64').reshape(-1)
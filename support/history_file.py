@@ -0,0 +1,126 @@
+# Patient histories in a binary file (.npz) that can be read without parsing.
+#   A history file holds the same data as a history CSV file, such as
+# train.csv or test.csv: for every patient a row of periods, each with a list
+# of feature=value items. The items are stored as a CSR matrix with a row per
+# patient and period and a column per feature:
+#     row = patient * num_periods + period
+# Every item of the CSV file is a stored value of the matrix, including items
+# with value 0, so the features that occur in a set of histories are exactly
+# the columns of its stored values.
+#   The arrays in the file are:
+#     praktijk_ids, patient_ids    the patients, in the order of the CSV file
+#     features                     the feature names, by column
+#     num_periods                  the number of periods per patient
+#     indptr, indices, data        the CSR matrix
+
+import numpy
+import os
+import scipy.sparse
+
+
+def write(filename, histories):
+    _save(filename, histories.patients, histories.features, histories.num_periods,
+          histories.matrix.indptr, histories.matrix.indices, histories.matrix.data)
+
+
+# Writes to a temporary file that then replaces the history file, rather than
+# overwriting the history file in place: the history files of an experiment
+# can be hard links into the history store, shared with other experiments.
+def _save(filename, patients, features, num_periods, indptr, indices, data):
+    temp_name = str(filename) + '.tmp'
+    # numpy.savez appends .npz to names that lack it, so write through a file object.
+    with open(temp_name, 'wb') as target:
+        numpy.savez(target,
+                    praktijk_ids=numpy.array([praktijk_id for praktijk_id, patient_id in patients], dtype=str),
+                    patient_ids=numpy.array([patient_id for praktijk_id, patient_id in patients], dtype=str),
+                    features=numpy.array(features, dtype=str),
+                    num_periods=num_periods,
+                    indptr=indptr,
+                    indices=indices,
+                    data=data)
+    os.replace(temp_name, str(filename))
+
+
+def read(filename):
+    with numpy.load(str(filename)) as data:
+        patients = list(zip(data['praktijk_ids'].tolist(), data['patient_ids'].tolist()))
+        features = data['features'].tolist()
+        num_periods = int(data['num_periods'])
+        shape = (len(patients) * num_periods, len(features))
+        matrix = scipy.sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=shape)
+    return Histories(patients, features, matrix, num_periods)
+
+
+class Histories:
+
+    def __init__(self, patients, features, matrix, num_periods):
+        self.patients = patients  # (praktijk id, patient id) pairs
+        self.features = features
+        self.matrix = matrix
+        self.num_periods = num_periods
+
+    def __len__(self):
+        return len(self.patients)
+
+    # The periods of a patient, as a CSR matrix with a row per period.
+    def periods(self, patient):
+        return self.matrix[patient * self.num_periods:(patient + 1) * self.num_periods]
+
+    # The names of the features that occur in these histories.
+    def used_features(self):
+        return [self.features[column] for column in numpy.unique(self.matrix.indices).tolist()]
+
+    # Returns the histories of the given patients, in the given order.
+    def select(self, patients):
+        patients = numpy.asarray(patients, dtype='int64')
+        rows = (patients[:, numpy.newaxis] * self.num_periods + numpy.arange(self.num_periods)).reshape(-1)
+        return Histories([self.patients[patient] for patient in patients.tolist()], self.features, self.matrix[rows], self.num_periods)
+
+
+# Writes a history file a few patients at a time, for histories that are
+# built one patient at a time. The matrix is appended to temporary files,
+# which are memory-mapped to assemble the history file on close, so it is
+# never held in memory as a whole. All parts must have the same features.
+class Writer:
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.patients = []
+        self.features = None
+        self.num_periods = 0
+        self.num_values = 0
+
+    def __enter__(self):
+        self.parts = {}  # name => (temporary file, dtype)
+        for name, dtype in (('indptr', 'int64'), ('indices', 'int32'), ('data', 'float64')):
+            self.parts[name] = (open(self.filename + '.' + name + '.tmp', 'wb+'), dtype)
+        numpy.zeros(1, dtype='int64').tofile(self.parts['indptr'][0])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                arrays = {name: self.read_part(part, dtype) for name, (part, dtype) in self.parts.items()}
+                _save(self.filename, self.patients, self.features or [], self.num_periods, **arrays)
+                del arrays
+        finally:
+            for part, dtype in self.parts.values():
+                part.close()
+                os.remove(part.name)
+
+    def write(self, histories):
+        if self.features is None:
+            self.features, self.num_periods = histories.features, histories.num_periods
+        assert histories.features == self.features and histories.num_periods == self.num_periods
+        matrix = histories.matrix
+        self.patients.extend(histories.patients)
+        (matrix.indptr[1:].astype('int64') + self.num_values).tofile(self.parts['indptr'][0])
+        matrix.indices.astype('int32').tofile(self.parts['indices'][0])
+        matrix.data.astype('float64').tofile(self.parts['data'][0])
+        self.num_values += matrix.nnz
+
+    def read_part(self, part, dtype):
+        part.flush()
+        if os.path.getsize(part.name) == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(part.name, dtype=dtype, mode='r')
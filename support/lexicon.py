@@ -0,0 +1,64 @@
+# A compiled word frequency list that can be opened without parsing.
+#   The words are stored as a sorted array of fixed-width UTF-8 byte strings,
+# with a parallel array of frequencies, each in its own .npy file. Both are
+# opened as memory maps, so opening is instantaneous, the operating system
+# shares the pages between processes, and only the pages actually touched by
+# a lookup are ever read from disk.
+#   Lookups are done in bulk by binary search (numpy.searchsorted), so it pays
+# to collect the words to look up and query them all at once.
+
+import numpy
+import os
+
+
+def _filenames(basename):
+    basename = str(basename)
+    return basename + '_words.npy', basename + '_freqs.npy'
+
+
+# Compiles (word, frequency) pairs into basename_words.npy and basename_freqs.npy.
+# The frequencies are written last, under a temporary name, so a compiled
+# lexicon is complete whenever basename_freqs.npy exists.
+def write(basename, word_freq):
+    word_freq = sorted((word.encode('utf-8'), freq) for word, freq in word_freq)
+    width = max((len(word) for word, freq in word_freq), default=1)
+    words = numpy.array([word for word, freq in word_freq], dtype='S{}'.format(width))
+    freqs = numpy.array([freq for word, freq in word_freq], dtype='int64')
+    words_file, freqs_file = _filenames(basename)
+    for filename, data in ((words_file, words), (freqs_file, freqs)):
+        # numpy.save appends .npy to names that lack it, so write through a file object.
+        with open(filename + '.tmp', 'wb') as target:
+            numpy.save(target, data)
+        os.replace(filename + '.tmp', filename)
+
+
+def exists(basename):
+    words_file, freqs_file = _filenames(basename)
+    return os.path.isfile(freqs_file)
+
+
+class Lexicon:
+
+    def __init__(self, basename):
+        words_file, freqs_file = _filenames(basename)
+        self.words = numpy.load(words_file, mmap_mode='r')
+        self.freqs = numpy.load(freqs_file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, word):
+        return int(self.lookup([word])[0])
+
+    # Returns an array with the frequency of every word, or 0 for unknown words.
+    def lookup(self, words):
+        words = [word.encode('utf-8') for word in words]
+        if not words or not len(self.words):
+            return numpy.zeros(len(words), dtype='int64')
+        width = self.words.dtype.itemsize
+        fits = numpy.array([len(word) <= width for word in words])  # Longer words cannot be present
+        keys = numpy.array(words, dtype=self.words.dtype)
+        index = numpy.searchsorted(self.words, keys)
+        index = numpy.minimum(index, len(self.words) - 1)
+        found = fits & (self.words[index] == keys)
+        return numpy.where(found, self.freqs[index], 0)
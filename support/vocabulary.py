@@ -0,0 +1,27 @@
+# Assigns consecutive integer ids to strings (or any other hashable values),
+# so that large streams of repeated values can be stored as integer arrays.
+#   words[ident] => value
+#   index[value] => ident
+
+class Vocabulary:
+
+    def __init__(self, words=()):
+        self.words = []
+        self.index = {}
+        for word in words:
+            self.encode(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    # Returns the id of a value, assigning a new id to values not seen before.
+    def encode(self, word):
+        ident = self.index.get(word)
+        if ident is None:
+            ident = len(self.words)
+            self.words.append(word)
+            self.index[word] = ident
+        return ident
+
+    def decode(self, ident):
+        return self.words[ident]
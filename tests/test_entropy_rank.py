@@ -0,0 +1,61 @@
+# Regression test for fit_relative_counts: rows that fit_model_curves fits in
+# batch must fit about as well as curve_fit (fit_relative_count) fits them,
+# with about the same relative entropy. Other rows fall back to curve_fit.
+# Nearly flat rows can have several minima of about the same cost, so the two
+# may settle in different ones: hence the tolerances.
+#   Run with pytest, or directly: python tests/test_entropy_rank.py
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import entropy_rank
+import numpy as np
+import warnings
+
+
+# Relative counts of keywords over the history: decaying or rising curves
+# with Poisson noise at several frequencies, and some sparse rows of noise.
+def sample_counts(num_rows=500, seed=0):
+    rng = np.random.default_rng(seed)
+    periods = np.linspace(0, 60, 61)
+    a = rng.uniform(-1, 3, num_rows)[:, None]
+    b = rng.uniform(0.005, 0.5, num_rows)[:, None]
+    c = rng.uniform(0.1, 2, num_rows)[:, None]
+    frequencies = rng.choice([1, 5, 20], num_rows)[:, None]
+    counts = rng.poisson(np.clip(entropy_rank.model_curve(periods, a, b, c), 0.01, None) * frequencies) / 100.0
+    sparse = rng.random(num_rows) < 0.2
+    counts[sparse] = rng.poisson(0.3, (sparse.sum(), len(periods))) / 100.0
+    return periods, counts
+
+
+def cost(periods, counts, abc):
+    return ((entropy_rank.model_curve(periods, *abc) - counts) ** 2).sum()
+
+
+def test_fit_relative_counts():
+    periods, counts = sample_counts()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        abc, converged = entropy_rank.fit_model_curves(periods, counts)
+        results = entropy_rank.fit_relative_counts((periods, counts))
+        references = [entropy_rank.fit_relative_count(periods, row) for row in counts]
+    batched = [index for index, result in enumerate(results) if result[3]]
+    assert len(batched) > len(counts) // 10
+    assert not any(result[3] for result in results if result[2] is not None)
+    differences = []
+    for index, result in enumerate(results):
+        reference = references[index]
+        if not result[3]:
+            assert result[:3] == reference, index
+            continue
+        assert converged[index] and reference[1] is not None, index
+        assert cost(periods, counts[index], abc[index]) <= 1.01 * cost(periods, counts[index], reference[0]), index
+        differences.append(abs(result[1] - reference[1]) / abs(reference[1]))
+    assert max(differences) < 0.1
+    assert np.mean(np.array(differences) < 0.01) > 0.9
+
+
+if __name__ == '__main__':
+    test_fit_relative_counts()
+    print('ok')
@@ -0,0 +1,106 @@
+# Regression test for Lemmatizer.lemmatize_tokens: the table-driven version
+# (spelling guard, affix tries, sublemma cache) must give every token the same
+# lemmas as the straightforward version below, which tries the spelling
+# patterns, prefixes and postfixes in turn. Identical token => lemmas means
+# identical tokens.csv and lemmas.csv.
+#   Run with pytest, or directly: python tests/test_lemmatize.py
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from support import config as CFG
+from support import my_csv as CSV
+
+import lemmatize
+import contextlib
+import io
+import random
+import re
+import tempfile
+
+
+SPELLING = [('ph', 'f'), ('(?<=[aeiou])y', 'ij'), ('ff', 'f'), ('c(?=[ao])', 'k')]
+PREFIXES = [('ont', 'ont'), ('on', 'niet-'), ('be', ''), ('o', '0')]
+POSTFIXES = [('heden', 'heid'), ('[aeiou]ts', 't'), ('en', ''), ('s', ''), ('ts', 'T')]
+
+# Patterns that refer to groups by number or name, which would refer to other
+# groups if the patterns were merged into one alternation: conditional groups
+# and backreferences, each tested on their own.
+CONDITIONAL_SPELLING = [('(x)y', 'z'), ('(a)?b(?(1)c|d)', 'q'), ('(?P<k>k)(?(k)o|u)', 'c')]
+BACKREFERENCE_SPELLING = [('(x)y', 'z'), ('(e)\\1', 'e'), ('(?P<o>o)(?P=o)', 'oe')]
+GROUP_TOKENS = {'abc', 'zabcz', 'bd', 'xyabc', 'koe', 'eek', 'ab-abc', 'xbd', 'boot'}
+
+
+# The lemmatizer before the table-driven version, with the tables above.
+def reference_lemmatize(token, spelling):
+    if lemmatize.INITIALISM.fullmatch(token):
+        return [''.join(c for c in token if c.isalpha())]
+    lemma = token
+    for pattern, replacement in spelling:
+        lemma = re.sub(pattern, replacement, lemma)
+    for prefix, replacement in PREFIXES:
+        if lemma.startswith(prefix):
+            lemma = replacement + lemma[len(prefix):]
+            break
+    for postfix, replacement in POSTFIXES:
+        lemma, count = re.subn(postfix + r'\Z', replacement, lemma)
+        if count: break
+    if lemmatize.SEPARATOR.search(lemma):
+        lemmas = [lemma for lemma in lemmatize.SEPARATOR.split(lemma) if lemma]
+        return sum((reference_lemmatize(lemma, spelling) for lemma in lemmas), [])
+    return [lemma]
+
+
+def sample_tokens():
+    rnd = random.Random(0)
+    characters = 'aeiouphscntybfk.-_'
+    tokens = {''.join(rnd.choice(characters) for i in range(rnd.randint(1, 12))) for j in range(20000)}
+    return tokens | {'a.b.c.', 'e.c.g.', 'onbeheden', 'foto-camera', 'pho-pho-pho'}
+
+
+def write_table(filename, headers, rows):
+    with CSV.FileWriter(filename) as target:
+        target.writerow(headers)
+        for row in rows:
+            target.writerow(row)
+
+
+# Runs Lemmatizer.lemmatize_tokens with the given spelling table and the
+# affix tables above, and checks every token against reference_lemmatize.
+def check_lemmatize_tokens(spelling, tokens):
+    data_dir = CFG.DATA_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        CFG.DATA_DIR = Path(directory)
+        try:
+            write_table(CFG.DATA_DIR / 'spelling.csv', ['PATTERN', 'REPLACEMENT'], spelling)
+            write_table(CFG.DATA_DIR / 'prefix.csv', ['PREFIX', 'REPLACEMENT'], PREFIXES)
+            write_table(CFG.DATA_DIR / 'postfix.csv', ['POSTFIX', 'REPLACEMENT'], POSTFIXES)
+            lemmatizer = lemmatize.Lemmatizer()
+            lemmatizer.token_freq = {token: 1 for token in tokens}
+            with contextlib.redirect_stdout(io.StringIO()):
+                lemmatizer.lemmatize_tokens()
+        finally:
+            CFG.DATA_DIR = data_dir
+    for token, lemmas in lemmatizer.token_lemmas.items():
+        assert lemmas == reference_lemmatize(token, spelling), token
+    assert len(lemmatizer.token_lemmas) == len(lemmatizer.token_freq)
+
+
+def test_lemmatize_tokens():
+    check_lemmatize_tokens(SPELLING, sample_tokens())
+
+
+def test_lemmatize_tokens_with_conditional_groups():
+    check_lemmatize_tokens(CONDITIONAL_SPELLING, GROUP_TOKENS | sample_tokens())
+
+
+def test_lemmatize_tokens_with_backreferences():
+    check_lemmatize_tokens(BACKREFERENCE_SPELLING, GROUP_TOKENS | sample_tokens())
+
+
+if __name__ == '__main__':
+    test_lemmatize_tokens()
+    test_lemmatize_tokens_with_conditional_groups()
+    test_lemmatize_tokens_with_backreferences()
+    print('ok')
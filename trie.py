@@ -0,0 +1,39 @@
+# Frequency-annotated trie -- See en.wikipedia.org/wiki/Trie
+
+# Every node is a dict mapping a character to its child node. A node that ends
+# a word also holds the word's frequency under the key None, which can never
+# collide with a character.
+#
+#   'ab' (3), 'abc' (5), 'b' (1)   ══►   {'a': {'b': {None: 3, 'c': {None: 5}}},
+#                                         'b': {None: 1}}
+
+
+class FrequencyTrie:
+
+    def __init__(self, word_freq=(), reverse=False):
+        self.root = {}
+        self.reverse = reverse  # Store words back to front, for suffix lookups
+        for word, freq in dict(word_freq).items():
+            self.add(word, freq)
+
+    def add(self, word, freq):
+        node = self.root
+        for char in (reversed(word) if self.reverse else word):
+            node = node.setdefault(char, {})
+        node[None] = freq
+
+    # Walks the trie along text[begin:end] (or backwards from end to begin in a
+    # reversed trie), and returns a list in which element i is the frequency
+    # of the word ending (or starting) at position i, or 0 if there is no such
+    # word. The list has len(text) + 1 elements.
+    def walk(self, text, begin=0, end=None):
+        if end is None: end = len(text)
+        freqs = (len(text) + 1) * [0]
+        node = self.root
+        positions = range(end - 1, begin - 1, -1) if self.reverse else range(begin, end)
+        for i in positions:
+            node = node.get(text[i])
+            if node is None: break
+            if None in node:
+                freqs[i if self.reverse else i + 1] = node[None]
+        return freqs
@@ -3,23 +3,53 @@ from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
 
+from multiprocessing.pool import ThreadPool
+import os
+import time
 import word2vec
 
 
 class Word2vecRanker:
 
+    # Trains one model per dimension in PAR.WORD2VEC_DIMS. The models are
+    # trained at the same time, sharing PAR.WORD2VEC_THREADS threads between
+    # them. Models that are newer than the training set are not retrained.
     def run(self):
         LOG.enter(self.__class__.__name__ + '.run()')
         source = CFG.PHASE2_DIR / 'Temp' / 'word2vec_train.txt'
+        LOG.message('Reading {}'.format(source))
+        dims = []
         for dim in PAR.WORD2VEC_DIMS:
-            LOG.enter('{} dimensions'.format(dim))
-            target = CFG.PHASE2_DIR / 'Keywords' / 'word2vec_{}.txt'.format(dim)
-            LOG.message('Reading {}'.format(source))
-            LOG.message('Writing {}'.format(target))
-            word2vec.word2vec(str(source), str(target), size=dim, cbow=1, threads=4, binary=0)
+            target = self.target_name(dim)
+            if target.is_file() and os.path.getmtime(str(target)) > os.path.getmtime(str(source)):
+                LOG.message('{} dimensions: {} is up to date'.format(dim, target))
+            else:
+                dims.append(dim)
+        if dims:
+            threads = max(1, PAR.WORD2VEC_THREADS // len(dims))
+            LOG.enter('Training {} models with {} threads each'.format(len(dims), threads))
+            # word2vec runs as a subprocess, so a thread per model is enough
+            with ThreadPool(len(dims)) as pool:
+                tasks = [(source, dim, threads) for dim in dims]
+                for dim, seconds in pool.imap_unordered(self.train, tasks):
+                    LOG.message('{} dimensions: wrote {} [{:.3f} sec]'.format(dim, self.target_name(dim), seconds))
             LOG.leave()
         LOG.leave()
 
+    def target_name(self, dim):
+        return CFG.PHASE2_DIR / 'Keywords' / 'word2vec_{}.txt'.format(dim)
+
+    # Trains into a temporary file, so that an interrupted run never leaves a
+    # partial model that looks up to date.
+    def train(self, task):
+        source, dim, threads = task
+        time_begin = time.time()
+        target = self.target_name(dim)
+        temp = target.with_name(target.name + '.tmp')
+        word2vec.word2vec(str(source), str(temp), size=dim, cbow=1, threads=threads, binary=0)
+        os.replace(str(temp), str(target))
+        return dim, time.time() - time_begin
+
 
 # Main program
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ from support import config as CFG
 from support import my_csv as CSV
 from support import logging as LOG
 from support import parameters as PAR
+from support import lexicon as LEX
 
 from collections import Counter
 
@@ -13,6 +14,7 @@ class WordfreqOptimizer:
         self.downcase()
         self.sort()
         self.write_output()
+        self.write_lexicon()
         LOG.leave()
 
     def read_opentaal(self):
@@ -68,6 +70,21 @@ class WordfreqOptimizer:
         LOG.message('{} unique words, {} tokens'.format(unique_words, corpus_size))
         LOG.leave()
 
+    # Also write the word frequencies as a compiled lexicon, which spellfix.py
+    # opens instantly instead of parsing a CSV file. Spellfix has always
+    # lower-cased the OpenTaal words rather than case-folding them ('ß' stays
+    # 'ß'), so the lexicon is lower-cased too.
+    def write_lexicon(self):
+        LOG.enter('writing compiled lexicon')
+        basename = CFG.PHASE1_DIR / 'Temp' / 'wordfreq'
+        LOG.message('to {}_*.npy'.format(basename))
+        lexicon = Counter()
+        for word, freq in self.opentaal:
+            lexicon[word.lower()] += freq
+        LEX.write(basename, lexicon.items())
+        LOG.message('{} unique words'.format(len(lexicon)))
+        LOG.leave()
+
 if __name__ == '__main__':
     LOG.enter(__file__)
     PAR.read(CFG.SOURCE_DIR)
@@ -1,6 +1,7 @@
 from support import config as CFG
 from support import logging as LOG
 from support import parameters as PAR
+from support import history_file as HF
 
 import os
 import random
@@ -20,6 +21,8 @@ class Splitter:
             LOG.enter('fold {}'.format(fold))
             self.write_train(directory, fold)
             self.write_test(directory, fold)
+            if self.histories:
+                self.write_binary(directory, fold)
             LOG.leave()
         LOG.leave()
 
@@ -33,6 +36,12 @@ class Splitter:
         for file in directory.glob('test_*.csv'):
             LOG.message('removing {}'.format(file))
             os.remove(str(file))
+        for file in directory.glob('train_*.npz'):
+            LOG.message('removing {}'.format(file))
+            os.remove(str(file))
+        for file in directory.glob('test_*.npz'):
+            LOG.message('removing {}'.format(file))
+            os.remove(str(file))
         LOG.leave()
 
     def read_data(self, directory):
@@ -42,12 +51,20 @@ class Splitter:
         with open(path, encoding='utf-8') as source:
             self.headers = next(source)
             self.data = [line for line in source]
+        # The binary histories, if they are up to date
+        path = directory / 'modeldata.npz'
+        self.histories = None
+        if path.is_file() and os.path.getmtime(str(path)) >= os.path.getmtime(str(directory / 'modeldata.csv')):
+            LOG.message('from {}'.format(path))
+            self.histories = HF.read(path)
         LOG.leave()
 
     def randomize(self):
         # Specify a seed if repeatable randomness is wanted.
         random.seed(1234)  # Any integer
-        random.shuffle(self.data)
+        self.patients = list(range(len(self.data)))  # Shuffled along with the lines
+        random.shuffle(self.patients)
+        self.data = [self.data[patient] for patient in self.patients]
 
     # Write the training data for a given fold.
     # If fold is 7, all lines are copied except line 7, 17, 27...
@@ -71,6 +88,13 @@ class Splitter:
                 if line_number % FOLDS == fold:
                     target.write(line)
 
+    # Write the binary histories for a given fold, split like the CSV files.
+    def write_binary(self, directory, fold):
+        train = [patient for line_number, patient in enumerate(self.patients) if line_number % FOLDS != fold]
+        test = [patient for line_number, patient in enumerate(self.patients) if line_number % FOLDS == fold]
+        HF.write(directory / 'train_{}.npz'.format(fold), self.histories.select(train))
+        HF.write(directory / 'test_{}.npz'.format(fold), self.histories.select(test))
+
 
 # Main program
 if __name__ == '__main__':